@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""End-to-end benchmarks of usermig against the local NerdGraph simulator.
+
+Each scenario starts a fresh simulator seeded with synthetic users and runs
+one workflow through the real code paths: a full domain migration, adding
+every user to a group, or dumping the users. It reports the number of
+requests, wall time, p50/p99 request latency and the peak RSS of the
+process that ran the workflow.
+
+    ./benchmark.py --users 1000,10000 --latency 0.05 --json results.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import requests
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import cache
+import directory
+import nerdgraph
+import planner
+import usermig
+import validation
+
+logger = logging.getLogger('usermig')
+
+WORKFLOWS = ("migrate", "add-to-group", "dump-users")
+SOURCE = "source"
+DESTINATION = "destination"
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+def groups_for(users):
+    return max(users // 50, 1)
+
+
+def write_tsv(path, users, workflow):
+    """Write the tsv a workflow reads, matching the users the simulator seeds."""
+    groups = groups_for(users)
+    with open(path, "w") as f:
+        f.write("\t".join(validation.FIELDS) + "\n")
+        for index in range(users):
+            if workflow == "add-to-group":
+                names = ["Benchmark group"]
+            else:
+                names = ["Group {}".format((index + offset) % groups) for offset in range(2)]
+            f.write("User {0}\tuser{0}@example.com\tBASIC_USER_TIER\t{1}\n".format(index, ",".join(names)))
+
+
+def start_simulator(options, users):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "simulator.py"),
+               "--port", "0", "--source-domain", SOURCE, "--users", str(users),
+               "--groups", str(groups_for(users)), "--page-size", str(options.page_size),
+               "--latency", str(options.latency), "--jitter", str(options.jitter),
+               "--throttle-rate", str(options.throttle_rate), "--error-rate", str(options.error_rate)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+
+def run_workflow(workflow, client, tsv, workdir):
+    snapshot_cache = cache.Cache(os.path.join(workdir, "cache"), ttl=0, refresh=True)
+    if workflow == "migrate":
+        options = argparse.Namespace(dryrun=False, resume=False, shard=None)
+        source = directory.Snapshot.fetch(client, SOURCE, True, users=False, groups=False, roles=True)
+        destination = directory.Snapshot.fetch(client, DESTINATION, True, roles=True)
+        plan = planner.build(validation.read_rows(tsv), source, destination)
+        usermig.migrate_domains(options, client, snapshot_cache, DESTINATION, plan, destination)
+    elif workflow == "add-to-group":
+        options = argparse.Namespace(dryrun=False)
+        usermig.add_to_group(options, client, snapshot_cache, validation.read_rows(tsv), SOURCE)
+    else:
+        options = argparse.Namespace(dryrun=False, output=os.devnull, gzip=False, format="tsv")
+        usermig.dump_users(options, client, SOURCE, snapshot_cache)
+
+
+def run_scenario(workflow, users, url, options):
+    """Run one workflow in this (fresh) process and measure it."""
+    logger.setLevel(logging.DEBUG if options.verbose else logging.WARNING)
+    with tempfile.TemporaryDirectory() as workdir:
+        tsv = os.path.join(workdir, "users.tsv")
+        write_tsv(tsv, users, workflow)
+        usermig.config = {"mutation_batch_size": options.mutation_batch_size,
+                          "membership_batch_size": options.membership_batch_size,
+                          "role_batch_size": options.role_batch_size,
+                          "lookup_batch_size": options.lookup_batch_size,
+                          "max_in_flight": options.max_in_flight,
+                          "journal": os.path.join(workdir, "usermig.journal")}
+        scheduler = nerdgraph.Scheduler(rate=options.requests_per_second,
+                                        max_concurrency=options.max_in_flight,
+                                        max_retries=options.max_retries)
+        latencies = []
+        with nerdgraph.Client("benchmark", url, pool_size=options.max_in_flight,
+                              scheduler=scheduler) as client:
+            client.session.hooks["response"].append(
+                lambda response, *args, **kwargs: latencies.append(response.elapsed.total_seconds()))
+            start = time.perf_counter()
+            run_workflow(workflow, client, tsv, workdir)
+            wall = time.perf_counter() - start
+    return {"workflow": workflow, "users": users, "requests": scheduler.counters["requests"],
+            "retries": scheduler.counters["retries"], "wall_s": round(wall, 3),
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def benchmark(workflow, users, options):
+    process, url = start_simulator(options, users)
+    try:
+        # A process per scenario so peak RSS is the scenario's own
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            result = pool.submit(run_scenario, workflow, users, url, options).result()
+        result["server_requests"] = requests.get(url, timeout=10).json().get("requests", 0)
+        return result
+    finally:
+        process.terminate()
+        process.wait()
+
+
+COLUMNS = ("workflow", "users", "requests", "retries", "wall_s", "p50_ms", "p99_ms", "peak_rss_mb")
+
+
+def report(results, out=sys.stdout):
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in COLUMNS]
+    out.write("  ".join(column.rjust(width) for column, width in zip(COLUMNS, widths)) + "\n")
+    for result in results:
+        out.write("  ".join(str(result[column]).rjust(width) for column, width in zip(COLUMNS, widths)) + "\n")
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1000,10000,100000", help="Comma separated domain sizes")
+    parser.add_argument("--workflows", default=",".join(WORKFLOWS), help="Comma separated workflows to run")
+    parser.add_argument("--page-size", type=int, default=100, help="Records per page of list queries")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the simulator adds to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra simulator latency, up to this much")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests throttled")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--max-in-flight", type=int, default=4)
+    parser.add_argument("--requests-per-second", type=float, default=None, help="Pacing, unpaced by default")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--mutation-batch-size", type=int, default=25)
+    parser.add_argument("--membership-batch-size", type=int, default=100)
+    parser.add_argument("--role-batch-size", type=int, default=100)
+    parser.add_argument("--lookup-batch-size", type=int, default=50)
+    parser.add_argument("--json", dest="json", default=None, help="Also write the results to this file")
+    parser.add_argument("--verbose", "-v", action="store_true", default=False, help="Log what usermig does")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    logging.basicConfig(format="%(message)s")
+    results = []
+    for users in (int(size) for size in options.users.split(",")):
+        for workflow in options.workflows.split(","):
+            if workflow not in WORKFLOWS:
+                sys.exit("Unknown workflow {}".format(workflow))
+            print("Running {} with {} users ...".format(workflow, users), file=sys.stderr)
+            results.append(benchmark(workflow, users, options))
+    report(results)
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
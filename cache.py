@@ -0,0 +1,100 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('usermig')
+
+
+class Cache:
+    """A read-through, on-disk cache of paginated directory queries.
+
+    Every list query result is kept as a JSON lines file named after its
+    authentication domain, query name and a digest of the exact document and
+    variables, so different projections of the same query never collide. The
+    first line records when the records were fetched; entries older than
+    ``ttl`` seconds are read from NerdGraph again.
+
+    Our own mutations keep the cache honest: created groups are appended to
+    the cached group lists, and queries whose records a migration is about
+    to change are dropped. With ``refresh`` nothing is read from the cache,
+    but fresh results still replace what is there.
+    """
+
+    def __init__(self, path, ttl=900, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, query):
+        variables = dict(query.variables())
+        variables.pop("cursor", None)
+        digest = hashlib.sha1(json.dumps([query.build_query(), variables],
+                                         sort_keys=True).encode()).hexdigest()[:12]
+        return "{}.{}.{}.jsonl".format(variables["authDomain"][0], query.name(), digest)
+
+    def fresh(self, filename):
+        try:
+            with open(filename, "r") as f:
+                header = json.loads(f.readline())
+        except (OSError, ValueError):
+            return False
+        return time.time() - header.get("fetched", 0) < self.ttl
+
+    def paginate(self, query, client, finalize: bool, prefetch: bool = False):
+        """Yield the records of ``query`` from the cache, or fetch and store them."""
+        filename = os.path.join(self.path, self.key(query))
+        if not self.refresh and self.fresh(filename):
+            logger.debug("Reading %s from cache %s", query.name(), filename)
+            with open(filename, "r") as f:
+                next(f)
+                for line in f:
+                    yield json.loads(line)
+            return
+        if not finalize:
+            yield from query.paginate(client, finalize, prefetch)
+            return
+
+        # Only a complete walk of the query replaces the cached entry
+        partial = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+        try:
+            with open(partial, "w") as f:
+                f.write(json.dumps({"fetched": time.time()}) + "\n")
+                for record in query.paginate(client, finalize, prefetch):
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                    yield record
+            os.replace(partial, filename)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def entries(self, auth_domain, name):
+        return glob.glob(os.path.join(glob.escape(self.path),
+                                      "{}.{}.*.jsonl".format(glob.escape(auth_domain), name)))
+
+    def invalidate(self, auth_domain, name=None):
+        """Drop the cached results of one query, or all of them, for a domain."""
+        with self.lock:
+            for filename in self.entries(auth_domain, name or "*"):
+                logger.debug("Invalidating cache %s", filename)
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+
+    def group_created(self, auth_domain, group_name, group_id):
+        """Add a group we just created to the cached group lists of its domain."""
+        record = {"displayName": group_name, "id": group_id}
+        with self.lock:
+            for filename in self.entries(auth_domain, "GroupsQuery"):
+                with open(filename, "a") as f:
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            for filename in self.entries(auth_domain, "RolesQuery"):
+                with open(filename, "a") as f:
+                    f.write(json.dumps(dict(record, roles={"roles": []}),
+                                       separators=(",", ":")) + "\n")
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('usermig')
+
+
+def shard_of(email, count: int):
+    """The shard an email belongs to. Stable across processes and hosts, unlike ``hash``."""
+    return int(hashlib.sha1(email.lower().encode()).hexdigest()[:8], 16) % count
+
+
+def digest(values):
+    """A short, order independent fingerprint of some values."""
+    return hashlib.sha1("\n".join(sorted(str(value) for value in values)).encode()).hexdigest()[:12]
+
+
+def parse_shard(spec):
+    """Turn ``I/N`` into ``(I, N)``."""
+    index, count = (int(part) for part in spec.split("/"))
+    if not 0 <= index < count:
+        raise ValueError("Shard {} is not between 0 and {}".format(index, count - 1))
+    return index, count
+
+
+class Coordinator:
+    """A SQLite file the shards of one migration share.
+
+    Anything that must happen exactly once across shards, such as creating a
+    group, is claimed first: the shard whose claim succeeds does the work and
+    publishes the result (the group id), and every other shard waits for it.
+    A shard may take over its own unpublished claims, so a crashed shard can
+    be re-run with ``--resume``. Shards also leave their summaries here so
+    any of them can report on the whole migration.
+
+    Claims are only exclusive as far as SQLite's file locking is, so every
+    shard must run on one host with the file on a local disk. The default
+    rollback journal is used; WAL mode does not work over a network filesystem at all.
+    """
+
+    def __init__(self, path, owner, timeout: float = 30):
+        self.path = path
+        self.owner = owner
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        # A file left in WAL mode by an older version is switched back
+        self.db.execute("PRAGMA journal_mode=DELETE")
+        self.db.execute("CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, owner TEXT, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS shards (name TEXT PRIMARY KEY, summary TEXT)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def claim(self, key):
+        """Try to become the one shard that handles ``key``."""
+        with self.lock:
+            inserted = self.db.execute("INSERT OR IGNORE INTO claims (key, owner) VALUES (?, ?)",
+                                       (key, self.owner)).rowcount
+            if inserted:
+                return True
+            row = self.db.execute("SELECT owner, value FROM claims WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] == self.owner and row[1] is None
+
+    def publish(self, key, value):
+        with self.lock:
+            self.db.execute("UPDATE claims SET value = ? WHERE key = ?", (value, key))
+
+    def release(self, key):
+        """Give up an unpublished claim, e.g. after failing to do the work."""
+        with self.lock:
+            self.db.execute("DELETE FROM claims WHERE key = ? AND owner = ? AND value IS NULL",
+                            (key, self.owner))
+
+    def wait(self, key, timeout: float = 600):
+        """Wait for another shard to publish ``key``. Returns None if it gives up or times out."""
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            with self.lock:
+                row = self.db.execute("SELECT value FROM claims WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[0] is not None:
+                return row[0]
+            if time.monotonic() >= deadline:
+                logger.error("Timed out waiting for another shard to handle {}".format(key))
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+
+    def finish(self, name, summary):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO shards (name, summary) VALUES (?, ?)",
+                            (name, json.dumps(summary)))
+
+    def summaries(self):
+        with self.lock:
+            rows = self.db.execute("SELECT summary FROM shards ORDER BY name").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,119 @@
+import logging
+import nerdgraph
+
+logger = logging.getLogger('usermig')
+
+
+def _paginate(query, client, finalize, cache):
+    if cache is None:
+        return query.paginate(client, finalize)
+    return cache.paginate(query, client, finalize)
+
+
+class Snapshot:
+    """A point-in-time, indexed copy of one authentication domain.
+
+    Users are indexed by email and groups by display name so lookups are
+    constant time. The indexes are updated in place as we create groups and
+    memberships, so a whole run only ever needs one directory read. When
+    fetched with ``roles``, the role grants of every group are indexed by
+    group display name as ``(accountId, roleId)`` pairs. Reads go through
+    ``cache`` when one is given.
+    """
+
+    def __init__(self, auth_domain):
+        self.auth_domain = auth_domain
+        self.users_by_email = dict()
+        self.groups_by_name = dict()
+        self.grants_by_group = dict()
+        self.missing = set()
+
+    @classmethod
+    def fetch(cls, client, auth_domain, finalize: bool, users=True, groups=True, roles=False,
+              cache=None):
+        snapshot = cls(auth_domain)
+        if users:
+            query = nerdgraph.UsersQuery(auth_domain, nerdgraph.MEMBERSHIP_FIELDS)
+            for user in _paginate(query, client, finalize, cache):
+                snapshot.add_user(user)
+        if groups:
+            query = nerdgraph.GroupsQuery(auth_domain)
+            for group in _paginate(query, client, finalize, cache):
+                snapshot.add_group(group['displayName'], group['id'])
+        if roles:
+            query = nerdgraph.RolesQuery(auth_domain, nerdgraph.GRANT_FIELDS)
+            for group in _paginate(query, client, finalize, cache):
+                snapshot.add_group(group['displayName'], group['id'])
+                snapshot.add_grants(group['displayName'], group['roles']['roles'])
+        logger.info("Read {} users, {} groups and {} role grants from domain {}".format(
+            len(snapshot.users_by_email), len(snapshot.groups_by_name),
+            sum(len(grants) for grants in snapshot.grants_by_group.values()), auth_domain))
+        return snapshot
+
+    def to_dict(self):
+        return {"auth_domain": self.auth_domain,
+                "users": {email: {"id": user["id"], "groups": sorted(user["groups"])}
+                          for email, user in self.users_by_email.items()},
+                "groups": self.groups_by_name,
+                "grants": {group: sorted([list(grant) for grant in grants], key=str)
+                           for group, grants in self.grants_by_group.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        snapshot = cls(data["auth_domain"])
+        for email, user in data["users"].items():
+            snapshot.users_by_email[email] = {"id": user["id"], "groups": set(user["groups"])}
+        snapshot.groups_by_name.update(data["groups"])
+        for group, grants in data["grants"].items():
+            snapshot.grants_by_group[group] = set(tuple(grant) for grant in grants)
+        return snapshot
+
+    def add_user(self, user):
+        groups = set(group['displayName'] for group in user['groups']['groups'])
+        self.users_by_email[user['email'].lower()] = {"id": user['id'], "groups": groups}
+        for group in user['groups']['groups']:
+            self.groups_by_name.setdefault(group['displayName'], group['id'])
+
+    def lookup(self, client, finalize: bool, emails, batch_size=50):
+        """Resolve just these emails with filtered lookups instead of a full read.
+
+        The snapshot doubles as the memo: emails it already knows, found or
+        not, are never asked for again.
+        """
+        wanted = list(dict.fromkeys(email.lower() for email in emails
+                                    if email.lower() not in self.users_by_email
+                                    and email.lower() not in self.missing))
+        for start in range(0, len(wanted), batch_size):
+            query = nerdgraph.UserLookup(self.auth_domain, wanted[start:start + batch_size])
+            data = query.execute(client, finalize)
+            if data is None and not finalize:
+                continue
+            for email, user in query.results(data).items():
+                if user is None:
+                    self.missing.add(email)
+                else:
+                    self.add_user(user)
+        if wanted:
+            logger.debug("Looked up %d users in domain %s", len(wanted), self.auth_domain)
+
+    def user(self, email):
+        return self.users_by_email.get(email.lower())
+
+    def add_group(self, name, group_id):
+        self.groups_by_name[name] = group_id
+
+    def group_id(self, name):
+        return self.groups_by_name.get(name)
+
+    def add_membership(self, email, group_name):
+        user = self.user(email)
+        if user is not None:
+            user["groups"].add(group_name)
+
+    def add_grants(self, group_name, roles):
+        grants = self.grants_by_group.setdefault(group_name, set())
+        for role in roles:
+            grants.add((role['accountId'], role['roleId']))
+
+    def grants(self, group_name):
+        return self.grants_by_group.get(group_name, set())
@@ -0,0 +1,67 @@
+import collections
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger('usermig')
+
+
+class Executor:
+    """Runs NerdGraph calls on a thread pool with a cap on in-flight work.
+
+    At most ``max_in_flight`` calls run at once and at most twice that many
+    are queued; ``submit`` blocks beyond that so a large input never turns
+    into an unbounded backlog of futures. With ``max_in_flight`` of 1 every
+    call runs inline on the calling thread, in order, which is the
+    deterministic mode to use when debugging.
+    """
+
+    def __init__(self, max_in_flight: int = 1):
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.pool = None
+        if self.max_in_flight > 1:
+            self.pool = ThreadPoolExecutor(max_workers=self.max_in_flight,
+                                           thread_name_prefix="usermig")
+            self.slots = threading.BoundedSemaphore(self.max_in_flight * 2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    @property
+    def serial(self):
+        return self.pool is None
+
+    def submit(self, fn, *args, **kwargs):
+        if self.pool is None:
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def map(self, fn, iterable):
+        """Like ``map`` but concurrent. Results come back in input order and the
+        input is consumed lazily, a bounded window ahead of the results."""
+        if self.pool is None:
+            for item in iterable:
+                yield fn(item)
+            return
+        window = collections.deque()
+        for item in iterable:
+            window.append(self.submit(fn, item))
+            if len(window) >= self.max_in_flight:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
@@ -0,0 +1,81 @@
+import contextlib
+import csv
+import gzip
+import io
+import json
+import logging
+import sys
+import time
+
+from tqdm import tqdm
+
+logger = logging.getLogger('usermig')
+
+FORMATS = ("tsv", "csv", "jsonl")
+HEADER = ["Name", "Email", "User type", "Groups"]
+
+# Make sure the output is API friendly
+USER_TYPES = {
+    "BASIC": "BASIC_USER_TIER",
+    "CORE": "CORE_USER_TIER",
+    "FULL PLATFORM": "FULL_USER_TIER"
+}
+
+BUFFER_SIZE = 1024 * 1024
+
+
+@contextlib.contextmanager
+def open_output(path, compress: bool = False):
+    """Open ``path`` (``-`` for stdout) for buffered text output, gzipped if asked
+    to or if the name ends in ``.gz``. Stdout is flushed but left open."""
+    if path in (None, "-"):
+        sys.stdout.flush()
+        raw = open(sys.stdout.fileno(), "wb", buffering=BUFFER_SIZE, closefd=False)
+    else:
+        raw = open(path, "wb", buffering=BUFFER_SIZE)
+    stream = raw
+    if compress or (path or "").endswith(".gz"):
+        stream = gzip.GzipFile(fileobj=raw, mode="wb")
+    out = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    try:
+        yield out
+    finally:
+        out.detach()
+        if stream is not raw:
+            stream.close()
+        raw.close()
+
+
+def user_row(user):
+    user_type = user['type']['displayName']
+    return [user['name'], user['email'], USER_TYPES.get(user_type.upper(), user_type),
+            [group['displayName'] for group in user['groups']['groups']]]
+
+
+def export_users(users, out, fmt: str = "tsv"):
+    """Write users from a (paginated) iterable as they arrive.
+
+    Nothing but the row being written is kept, so memory stays flat however
+    big the domain is. Returns the number of users written.
+    """
+    if fmt == "jsonl":
+        def write(row):
+            out.write(json.dumps(dict(zip(HEADER, row))) + "\n")
+    else:
+        writer = csv.writer(out, delimiter="\t" if fmt == "tsv" else ",", lineterminator="\n")
+        writer.writerow(HEADER)
+
+        def write(row):
+            row[3] = ",".join(row[3])
+            writer.writerow(row)
+
+    count = 0
+    started = time.monotonic()
+    with tqdm(unit=" users", desc="Exporting", file=sys.stderr, disable=None) as progress:
+        for user in users:
+            write(user_row(user))
+            count += 1
+            progress.update()
+    elapsed = max(time.monotonic() - started, 1e-6)
+    logger.info("Exported {} users in {:.1f}s ({:.0f} users/s)".format(count, elapsed, count / elapsed))
+    return count
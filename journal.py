@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger('usermig')
+
+
+class Journal:
+    """An append-only JSONL record of the operations a migration completed.
+
+    Every created user, created group, added membership and granted role is
+    written as one line along with the ids NerdGraph returned. Lines are
+    flushed as they are written and fsync'd every ``sync_every`` records (and
+    on close), so a crash loses at most the last few unsynced entries.
+    Replaying the file on ``--resume`` rebuilds what was done in one pass so
+    the migration only issues what is still missing.
+    """
+
+    def __init__(self, path, destination_domain_id, sync_every: int = 50):
+        self.path = path
+        self.destination_domain_id = destination_domain_id
+        self.sync_every = max(int(sync_every), 1)
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.file = None
+        self.users = dict()
+        self.groups = dict()
+        self.memberships = set()
+        self.grants = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self, resume: bool):
+        if resume and os.path.exists(self.path):
+            self.replay()
+            self.file = open(self.path, "a")
+        else:
+            self.file = open(self.path, "w")
+            self.record("start", domain=self.destination_domain_id)
+        return self
+
+    def replay(self):
+        with open(self.path, "r") as f:
+            for line_num, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-write
+                    logger.warning("Ignoring unreadable journal line {}".format(line_num))
+                    continue
+                kind = entry.get("op")
+                if kind == "start" and entry["domain"] != self.destination_domain_id:
+                    raise Exception("Journal {} belongs to domain {}, not {}".format(
+                        self.path, entry["domain"], self.destination_domain_id))
+                elif kind == "user":
+                    self.users[entry["email"]] = entry["id"]
+                elif kind == "group":
+                    self.groups[entry["name"]] = entry["id"]
+                elif kind == "membership":
+                    for user_id in entry["user_ids"]:
+                        self.memberships.add((entry["group_id"], user_id))
+                elif kind == "grant":
+                    for account_id, role_id in entry["grants"]:
+                        self.grants.add((entry["group_id"], account_id, role_id))
+        logger.info("Resuming from {}: {} users, {} groups, {} memberships and {} role grants already done".format(
+            self.path, len(self.users), len(self.groups), len(self.memberships), len(self.grants)))
+
+    def record(self, op, **fields):
+        fields["op"] = op
+        line = json.dumps(fields) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                os.fsync(self.file.fileno())
+                self.unsynced = 0
+
+    def user_created(self, email, user_id):
+        self.users[email] = user_id
+        self.record("user", email=email, id=user_id)
+
+    def group_created(self, name, group_id):
+        self.groups[name] = group_id
+        self.record("group", name=name, id=group_id)
+
+    def members_added(self, group_id, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.memberships.add((group_id, user_id))
+        self.record("membership", group_id=group_id, user_ids=list(user_ids))
+
+    def roles_granted(self, group_id, grants):
+        with self.lock:
+            for account_id, role_id in grants:
+                self.grants.add((group_id, account_id, role_id))
+        self.record("grant", group_id=group_id, grants=[list(grant) for grant in grants])
+
+    def close(self):
+        if self.file is None:
+            return
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
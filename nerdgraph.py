@@ -1,74 +1,484 @@
+from email.utils import parsedate_to_datetime
+import functools
 import json
+import random
+import re
 import requests
+import requests.adapters
+import urllib3.exceptions
 import logging
-from string import Template
+import multiprocessing
+import threading
+import time
+from typing import NamedTuple, Optional
+
+import telemetry
+
+# orjson parses noticeably faster when it is installed; the stdlib is the fallback
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(payload):
+        return json.dumps(payload, separators=(",", ":")).encode()
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger('usermig')
 
+NERDGRAPH_URL = "https://api.newrelic.com/graphql"
+
+
+class SharedBucket:
+    """A token bucket shared by several processes, e.g. every job using one API key.
+
+    It has to be created before the worker processes and handed to them
+    when they start.
+    """
+
+    def __init__(self, rate: float, burst: int = None, context=None):
+        context = context or multiprocessing.get_context()
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.lock = context.Lock()
+        self.tokens = context.RawValue("d", self.capacity)
+        self.refilled = context.RawValue("d", time.monotonic())
+
+    def take(self):
+        """Take a token and return 0, or return how long to wait for one."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens.value = min(self.capacity,
+                                    self.tokens.value + (now - self.refilled.value) * self.rate)
+            self.refilled.value = now
+            if self.tokens.value >= 1:
+                self.tokens.value -= 1
+                return 0
+            return (1 - self.tokens.value) / self.rate
+
+
+class Scheduler:
+    """Paces requests to NerdGraph and backs off when it pushes back.
+
+    Requests draw from a token bucket refilled at ``rate`` per second (no
+    pacing when ``rate`` is falsy). The number of concurrent requests follows
+    AIMD: every throttled response halves the limit, and each run of
+    ``limit`` clean responses raises it by one, up to ``max_concurrency``.
+    Retries wait for ``Retry-After`` when the server sends one and for an
+    exponential backoff with full jitter otherwise. A ``SharedBucket`` caps
+    the rate across processes on top of that.
+    """
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, rate: float = None, burst: int = None, max_concurrency: int = 16,
+                 max_retries: int = 5, backoff: float = 0.5, max_backoff: float = 60,
+                 shared: SharedBucket = None):
+        self.rate = rate
+        self.shared = shared
+        self.capacity = burst or max(rate or 1, 1)
+        self.tokens = self.capacity
+        self.refilled = time.monotonic()
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.limit = self.max_concurrency
+        self.in_flight = 0
+        self.clean = 0
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cond = threading.Condition()
+        self.bucket = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "throttled": 0, "failed": 0}
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+            self.counters["requests"] += 1
+        self._take_token()
+
+    def _take_token(self):
+        if self.shared is not None:
+            wait = self.shared.take()
+            while wait:
+                time.sleep(wait)
+                wait = self.shared.take()
+        if not self.rate:
+            return
+        while True:
+            with self.bucket:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def release(self, throttled: bool):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.counters["throttled"] += 1
+                self.limit = max(1, self.limit // 2)
+                self.clean = 0
+                logger.warning("NerdGraph is throttling, concurrency lowered to %d", self.limit)
+            else:
+                self.clean += 1
+                if self.clean >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.clean = 0
+            self.cond.notify_all()
+
+    def delay(self, attempt: int, retry_after=None):
+        """How long to wait before retry number ``attempt`` (0 based)."""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                try:
+                    when = parsedate_to_datetime(retry_after)
+                except (TypeError, ValueError):
+                    when = None
+                if when is not None:
+                    return min(max(when.timestamp() - time.time(), 0), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def retry(self, attempt: int, reason, retry_after=None):
+        """Sleep before another attempt, or return False once retries are used up."""
+        if attempt >= self.max_retries:
+            with self.cond:
+                self.counters["failed"] += 1
+            return False
+        wait = self.delay(attempt, retry_after)
+        with self.cond:
+            self.counters["retries"] += 1
+        logger.warning("%s. Retrying in %.1fs (%d/%d)", reason, wait, attempt + 1, self.max_retries)
+        time.sleep(wait)
+        return True
+
+
+def _unsent(error):
+    """Whether a failed request never reached NerdGraph, so sending it again is safe."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def _throttled(response):
+    if response.status_code == 429:
+        return True
+    # NerdGraph also reports rate limiting as a GraphQL error on a 200 response.
+    # The bytes test only skips decoding the common case; the string may just
+    # as well be user data, so only the errors themselves count.
+    if response.status_code != requests.codes.ok or b"TOO_MANY_REQUESTS" not in response.content:
+        return False
+    try:
+        errors = decode(response.content).get("errors") or []
+    except (ValueError, AttributeError):
+        return False
+    return any("TOO_MANY_REQUESTS" in (error.get("message") or "")
+               or (error.get("extensions") or {}).get("errorClass") == "TOO_MANY_REQUESTS"
+               for error in errors)
+
+
+class Client:
+    """A pooled, keep-alive HTTP session shared by every query of a run.
+
+    Creating one session per request pays a fresh TCP and TLS handshake each
+    time. A single client keeps up to ``pool_size`` connections open and hands
+    them back out, which is where most of the wall clock of a large migration
+    used to go. Every request goes through ``scheduler`` for pacing and
+    retries.
+    """
+
+    def __init__(self, api_key: str, url: str = NERDGRAPH_URL, pool_size: int = 10, timeout: float = 60,
+                 scheduler: Scheduler = None):
+        self.api_key = api_key
+        self.url = url
+        self.timeout = timeout
+        self.scheduler = scheduler or Scheduler(max_concurrency=pool_size)
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                                     pool_maxsize=pool_size,
+                                                     pool_block=True)
+        self.session = requests.Session()
+        self.session.headers.update({"API-Key": api_key, "Connection": "keep-alive",
+                                     "Content-Type": "application/json"})
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.closed = False
+        self._stats = {"opened": 0, "requests": 0}
+        self.telemetry = telemetry.Telemetry()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def post(self, body: bytes, name: str = "GraphQL", idempotent: bool = True):
+        """POST an already JSON-encoded GraphQL payload, retrying as the scheduler allows.
+
+        A request that is not ``idempotent`` is only sent again when it was
+        throttled or never got through to NerdGraph. After a read timeout or a
+        5xx it may well have been applied, and sending it again could create
+        the same user or group twice.
+
+        The call is recorded in ``telemetry`` under ``name`` once it completes,
+        with its retries and its latency including them.
+        """
+        attempt = 0
+        started = time.perf_counter()
+        while True:
+            self.scheduler.acquire()
+            response = None
+            try:
+                response = self.session.post(self.url, data=body, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.scheduler.release(False)
+                if not (idempotent or _unsent(e)) or not self.scheduler.retry(attempt, "Request failed: {}".format(e)):
+                    self.telemetry.record(name, time.perf_counter() - started, len(body), 0,
+                                          attempt, failed=True)
+                    raise
+                attempt += 1
+                continue
+            throttled = _throttled(response)
+            self.scheduler.release(throttled)
+            if not throttled and (response.status_code not in Scheduler.RETRY_STATUS or not idempotent):
+                break
+            reason = "NerdGraph returned {}".format(
+                "TOO_MANY_REQUESTS" if throttled else response.status_code)
+            if not self.scheduler.retry(attempt, reason, response.headers.get("Retry-After")):
+                break
+            attempt += 1
+        self.telemetry.record(name, time.perf_counter() - started, len(body), len(response.content),
+                              attempt, failed=response.status_code != requests.codes.ok)
+        return response
+
+    def connection_stats(self):
+        """Return how many connections were opened and how many were reused."""
+        if self.closed:
+            stats = dict(self._stats)
+        else:
+            stats = {"opened": 0, "requests": 0}
+            pools = self.adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                stats["opened"] += pool.num_connections
+                stats["requests"] += pool.num_requests
+        stats["reused"] = max(stats["requests"] - stats["opened"], 0)
+        return stats
+
+    def close(self):
+        if self.closed:
+            return
+        self._stats = self.connection_stats()
+        del self._stats["reused"]
+        self.closed = True
+        self.session.close()
+        stats = self.connection_stats()
+        logger.info("Closed NerdGraph client. Connections opened: {}, reused: {}".format(
+            stats["opened"], stats["reused"]))
+        counters = self.scheduler.counters
+        logger.info("Requests: {}, retries: {}, throttled: {}, gave up: {}".format(
+            counters["requests"], counters["retries"], counters["throttled"], counters["failed"]))
+        self.telemetry.summary()
+
+
+# Projections for the workflows in usermig.py: only what each one reads
+DUMP_FIELDS = ("name", "email", "type", "groups")
+MEMBERSHIP_FIELDS = ("id", "email", "groups")
+GRANT_FIELDS = ("roleId", "accountId")
+
+
+def encode(payload) -> bytes:
+    return _dumps(payload)
+
+
+def decode(content: bytes):
+    """Parse a response body straight from bytes, without a decoded text copy."""
+    return _loads(content)
+
+
+class Page(NamedTuple):
+    """The records of one page of a list query and the cursor of the next one."""
+    records: list
+    next_cursor: Optional[str]
+
+
+def _authentication_domain(data, root="userManagement"):
+    domains = data['data']['actor']['organization'][root]['authenticationDomains']['authenticationDomains']
+    return domains[0] if domains else None
+
+
+def minify(document):
+    """Collapse a GraphQL document onto one line without redundant whitespace."""
+    return re.sub(r"\s*([{}():,\[\]!])\s*", r"\1", " ".join(document.split()))
+
+
+@functools.lru_cache(maxsize=64)
+def _projected(cls, fields):
+    unknown = set(fields) - set(cls.FIELDS)
+    if unknown:
+        raise ValueError("{} has no fields {}".format(cls.__name__, ", ".join(sorted(unknown))))
+    return minify(cls.DOCUMENT.replace("FIELDS", " ".join(cls.FIELDS[field] for field in fields)))
+
 
 class GraphQL:
+    """Base for every NerdGraph operation.
+
+    Each operation defines its document once, as a minified ``QUERY`` with
+    typed ``$variables``, and ``variables()`` supplies the values for one
+    call. Values never get interpolated into the document text, so quotes or
+    braces in names are harmless and the same document object is sent for
+    every call.
+
+    List queries name the ``LIST`` of records they page through under the
+    ``ROOT`` of the response, and ``page()`` pulls out just that list and the
+    next cursor.
+
+    List queries that support projection define ``DOCUMENT`` with a
+    ``FIELDS`` placeholder and a ``FIELDS`` dict of the selections it can
+    stand for. Setting ``fields`` on an instance asks for just those, and
+    each distinct projection is built once and cached.
+    """
+    QUERY = None
+    DOCUMENT = None
+    FIELDS = None
+    ROOT = "userManagement"
+    LIST = None
+    # Whether sending the operation twice does no harm
+    IDEMPOTENT = True
+    cursor = None
+    fields = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "DOCUMENT" in cls.__dict__:
+            cls.QUERY = _projected(cls, tuple(cls.FIELDS))
+
     def build_query(self):
-        pass
+        if self.fields is None:
+            return self.QUERY
+        return _projected(type(self), tuple(self.fields))
+
+    def variables(self):
+        return {}
 
     def name(self):
         pass
 
-    def execute(self, api_key: str, finalize: bool):
-        url = "https://api.newrelic.com/graphql"
+    def page(self, data):
+        """Return the ``Page`` of records in a list query response, or None."""
+        if self.LIST is None:
+            return None
+        domain = _authentication_domain(data, self.ROOT)
+        if not domain:
+            return None
+        node = domain[self.LIST]
+        return Page(node[self.LIST], node.get("nextCursor"))
+
+    def _fetch_page(self, client, finalize, cursor):
+        self.cursor = cursor
+        data = self.execute(client, finalize)
+        if data is None and not finalize:
+            return None
+        # A page that failed must not pass for the end of the listing
+        if not data or data.get("errors") or not data.get("data"):
+            raise Exception("{} failed at cursor {}: {}".format(self.name(), cursor, "; ".join(
+                error.get("message", "") for error in (data or {}).get("errors", [])) or "no data"))
+        return self.page(data)
+
+    def pages(self, client, finalize: bool, prefetch: bool = False):
+        """Lazily walk ``nextCursor`` and yield each page of a list query.
+
+        With ``prefetch`` the next page is requested on a background thread as
+        soon as its cursor is known, so it downloads while the caller is still
+        working through the current one.
+        """
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch") if prefetch else None
+        try:
+            cursor = None
+            page = self._fetch_page(client, finalize, cursor)
+            while page is not None:
+                next_cursor = page.next_cursor
+                if not next_cursor or next_cursor == cursor:
+                    yield page
+                    return
+                logger.debug("%s following cursor %s", self.name(), next_cursor)
+                upcoming = pool.submit(self._fetch_page, client, finalize, next_cursor) if pool else None
+                yield page
+                cursor = next_cursor
+                page = upcoming.result() if upcoming else self._fetch_page(client, finalize, cursor)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    def paginate(self, client, finalize: bool, prefetch: bool = False):
+        """Lazily walk ``nextCursor`` and yield every record of a list query.
+
+        Only one page (two with ``prefetch``) is held in memory at a time, and
+        callers can start working on the first records before the last page
+        has been fetched.
+        """
+        for page in self.pages(client, finalize, prefetch):
+            yield from page.records
+
+    def execute(self, client: Client, finalize: bool):
         graphql = None
         try:
             query = self.build_query()
-            logger.debug("Executing query {}...".format(query))
             if isinstance(query, str):
-                graphql = {"query": query.replace("\n", "")}
+                graphql = {"query": query, "variables": self.variables()}
+                logger.debug("Executing %s with %s...", self.name(), graphql["variables"])
             else:
                 raise Exception("Invalid query")
         except Exception as e:
             logger.error(e)
 
         if finalize is False:
-            logger.info("NRQL: {}".format(graphql))
+            logger.info("NRQL: %s", graphql)
             return
 
-        headers = {"API-Key": api_key}
-        client = requests.Session()
-        client.headers.update(headers)
-
-        response = client.post(url, json=graphql)
+        body = encode(graphql)
+        response = client.post(body, self.name(), self.IDEMPOTENT)
         response.raise_for_status()
 
         if response.status_code == requests.codes.ok:
-            text = response.text
-            if isinstance(text, str):
-                try:
-                    jsondata = json.loads(text)
-                    if "errors" in jsondata:
-                        logger.error("{}".format(
-                            jsondata["errors"][0]["message"]))
-                    else:
-                        logger.debug("Response [{}]".format(text))
-                    return jsondata
-                except Exception as e:
-                    logger.error(e)
-                    raise e
+            try:
+                jsondata = decode(response.content)
+            except ValueError as e:
+                logger.error(e)
+                raise e
+            if "errors" in jsondata:
+                client.telemetry.error(self.name())
+                logger.error("; ".join(
+                    error.get("message", "") for error in jsondata["errors"]))
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response [%s]", response.content.decode("utf-8", "replace"))
+            return jsondata
 
 class GroupsQuery(GraphQL):
-    def __init__(self, auth_domain):
-        self.auth_domain = auth_domain
-
-    def build_query(self):
-        return Template("""
-{
+    LIST = "groups"
+    QUERY = minify("""
+query GroupsQuery($authDomain: [ID!], $cursor: String) {
   actor {
     organization {
       userManagement {
-        authenticationDomains(id: "$auth_domain") {
+        authenticationDomains(id: $authDomain) {
           authenticationDomains {
-            groups {
+            groups(cursor: $cursor) {
               groups {
                 displayName
                 id
               }
+              nextCursor
             }
           }
         }
@@ -76,40 +486,29 @@ class GroupsQuery(GraphQL):
     }
   }
 }
-        """).substitute(self.__dict__)
+""")
+
+    def __init__(self, auth_domain):
+        self.auth_domain = auth_domain
+
+    def variables(self):
+        return {"authDomain": [self.auth_domain], "cursor": self.cursor}
 
     def name(self):
         return "GroupsQuery"
 
 class UsersQuery(GraphQL):
-    def __init__(self, auth_domain):
-        self.auth_domain = auth_domain
-
-    def build_query(self):
-        return Template("""
-{
+    LIST = "users"
+    DOCUMENT = """
+query UsersQuery($authDomain: [ID!], $cursor: String) {
   actor {
     organization {
       userManagement {
-        authenticationDomains(id: "$auth_domain") {
+        authenticationDomains(id: $authDomain) {
           authenticationDomains {
-            users {
+            users(cursor: $cursor) {
               users {
-                type {
-                  displayName
-                  id
-                }
-                name
-                timeZone
-                groups {
-                  groups {
-                    id
-                    displayName
-                  }
-                }
-                email
-                emailVerificationState
-                id
+                FIELDS
               }
               nextCursor
             }
@@ -119,38 +518,49 @@ class UsersQuery(GraphQL):
     }
   }
 }
-        """).substitute(self.__dict__)
+"""
+    FIELDS = {
+        "type": "type { displayName id }",
+        "name": "name",
+        "timeZone": "timeZone",
+        "groups": "groups { groups { id displayName } }",
+        "email": "email",
+        "emailVerificationState": "emailVerificationState",
+        "id": "id",
+    }
+
+    def __init__(self, auth_domain, fields=None):
+        self.auth_domain = auth_domain
+        self.fields = fields
+
+    def variables(self):
+        return {"authDomain": [self.auth_domain], "cursor": self.cursor}
 
     def name(self):
         return "UsersQuery"
 
 
 class RolesQuery(GraphQL):
-    def __init__(self, source_domain_id):
-        self.source_domain_id = source_domain_id
-
-    def build_query(self):
-        return Template("""
-{
+    ROOT = "authorizationManagement"
+    LIST = "groups"
+    DOCUMENT = """
+query RolesQuery($authDomain: [ID!], $cursor: String) {
   actor {
     organization {
       authorizationManagement {
-        authenticationDomains(id: "$source_domain_id") {
+        authenticationDomains(id: $authDomain) {
           authenticationDomains {
-            groups {
+            groups(cursor: $cursor) {
               groups {
                 displayName
                 id
                 roles {
                   roles {
-                    id
-                    name
-                    roleId
-                    type
-                    accountId
+                    FIELDS
                   }
                 }
               }
+              nextCursor
             }
           }
         }
@@ -158,203 +568,471 @@ class RolesQuery(GraphQL):
     }
   }
 }
-        """).substitute(self.__dict__)
+"""
+    FIELDS = {
+        "id": "id",
+        "name": "name",
+        "roleId": "roleId",
+        "type": "type",
+        "accountId": "accountId",
+    }
+
+    def __init__(self, source_domain_id, fields=None):
+        self.source_domain_id = source_domain_id
+        self.fields = fields
+
+    def variables(self):
+        return {"authDomain": [self.source_domain_id], "cursor": self.cursor}
 
     def name(self):
         return "RolesQuery"
 
 
-class CreateUser(GraphQL):
+@functools.lru_cache(maxsize=64)
+def _lookup_document(count, fields):
+    selection = " ".join(UsersQuery.FIELDS[field] for field in fields)
+    definitions = "".join(",$e{}:String".format(index) for index in range(count))
+    lookups = " ".join("u{0}:users(filter:{{email:{{eq:$e{0}}}}}){{users{{{1}}}}}".format(index, selection)
+                       for index in range(count))
+    return minify(("query UserLookup($authDomain:[ID!]{}){{actor{{organization{{userManagement{{"
+                   "authenticationDomains(id:$authDomain){{authenticationDomains{{{}}}}}}}}}}}}}").format(
+        definitions, lookups))
+
+
+class UserLookup(GraphQL):
+    """Resolve a batch of emails to users with one filtered lookup per email.
+
+    Every email gets its own aliased ``users(filter: {email: {eq: ...}})``
+    field, so a single small request replaces a walk of the whole directory
+    when only a few users are needed. The document only depends on the
+    number of emails and is built once per batch size.
+    """
+
+    def __init__(self, auth_domain, emails, fields=MEMBERSHIP_FIELDS):
+        self.auth_domain = auth_domain
+        self.emails = list(emails)
+        self.fields = tuple(fields)
+
+    def build_query(self):
+        return _lookup_document(len(self.emails), self.fields)
+
+    def variables(self):
+        variables = {"authDomain": [self.auth_domain]}
+        for index, email in enumerate(self.emails):
+            variables["e{}".format(index)] = email
+        return variables
+
+    def results(self, data):
+        """Map each email to its user record, or None when it does not exist.
+
+        A response with errors or without data says nothing about the emails,
+        so it raises instead of reporting them all missing.
+        """
+        if not data or data.get("errors") or not data.get("data"):
+            raise Exception("UserLookup failed: {}".format("; ".join(
+                error.get("message", "") for error in (data or {}).get("errors", [])) or "no data"))
+        domain = _authentication_domain(data)
+        found = dict()
+        for index, email in enumerate(self.emails):
+            users = ((domain or {}).get("u{}".format(index)) or {}).get("users") or []
+            found[email] = next((user for user in users
+                                 if user["email"].lower() == email.lower()), None)
+        return found
+
+    def name(self):
+        return "UserLookup"
+
+
+class Mutation(GraphQL):
+    """A single root mutation field.
+
+    ``FIELD`` is the root field with its selection set, referring to the
+    variables declared in ``VARIABLE_TYPES``. The standalone ``QUERY`` is
+    built from them once per class, and ``MultiMutation`` can alias the same
+    field alongside others.
+    """
+    field = None
+    FIELD = None
+    VARIABLE_TYPES = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.FIELD:
+            cls.FIELD = minify(cls.FIELD)
+            definitions = ",".join("${}:{}".format(name, type) for name, type in cls.VARIABLE_TYPES.items())
+            cls.QUERY = "mutation {}({}){{{}}}".format(cls.__name__, definitions, cls.FIELD)
+
+    def result(self, data):
+        """The payload of this mutation's root field in a response, or None."""
+        if not data:
+            return None
+        return (data.get("data") or {}).get(self.field)
+
+
+class CreateUser(Mutation):
+    field = "userManagementCreateUser"
+    IDEMPOTENT = False
+    FIELD = """
+userManagementCreateUser(createUserOptions: $options) {
+  createdUser {
+    id
+  }
+}
+"""
+    VARIABLE_TYPES = {"options": "UserManagementCreateUser!"}
+
     def __init__(self, email, name, user_type, auth_domain_id):
         self.email = email
-        self.name = name
+        self.user_name = name
         self.user_type = user_type
         self.auth_domain_id = auth_domain_id
 
-    def build_query(self):
-        return Template("""
-mutation {
-  userManagementCreateUser(createUserOptions: {email: "$email", name: "$name", userType: $user_type, authenticationDomainId: "$auth_domain_id"})
-  {createdUser {id}}
-}
-        """).substitute(self.__dict__)
+    def variables(self):
+        return {"options": {"email": self.email, "name": self.user_name, "userType": self.user_type,
+                            "authenticationDomainId": self.auth_domain_id}}
+
+    def created_id(self, data):
+        """The id of the user this created, or None if it failed."""
+        created = self.result(data)
+        return created['createdUser']['id'] if created else None
 
     def name(self):
         return "CreateUser"
 
 
-class CreateGroup(GraphQL):
+class CreateGroup(Mutation):
+    field = "userManagementCreateGroup"
+    IDEMPOTENT = False
+    FIELD = """
+userManagementCreateGroup(createGroupOptions: $options) {
+  group {
+    displayName
+    id
+  }
+}
+"""
+    VARIABLE_TYPES = {"options": "UserManagementCreateGroup!"}
+
     def __init__(self, auth_domain, group_name):
         self.auth_domain = auth_domain
         self.group_name = group_name
 
-    def build_query(self):
-        return Template("""
-mutation {
-  userManagementCreateGroup(
-    createGroupOptions: {
-      authenticationDomainId: "$auth_domain"
-      displayName: "$group_name"
-    }
-  ) {
-    group {
-      displayName
-      id
-    }
-  }
-}
-        """).substitute(self.__dict__)
+    def variables(self):
+        return {"options": {"authenticationDomainId": self.auth_domain, "displayName": self.group_name}}
+
+    def created_id(self, data):
+        """The id of the group this created, or None if it failed."""
+        created = self.result(data)
+        return created['group']['id'] if created else None
 
     def name(self):
         return "CreateGroup"
 
 
-class AssignRole(GraphQL):
+class AssignRole(Mutation):
+    field = "authorizationManagementGrantAccess"
+    FIELD = """
+authorizationManagementGrantAccess(grantAccessOptions: $options) {
+  roles {
+    roleId
+    accountId
+  }
+}
+"""
+    VARIABLE_TYPES = {"options": "AuthorizationManagementGrantAccess!"}
+
     def __init__(self, group_id, account_id, role_id):
         self.group_id = group_id
-        self.account_id = account_id
-        self.role_id = role_id
+        self.grants = [(account_id, role_id)]
 
-    def build_query(self):
-        if self.account_id:
-            return Template("""
-mutation {
-  authorizationManagementGrantAccess(
-    grantAccessOptions: {
-      groupId: "$group_id"
-      accountAccessGrants: {
-        accountId: $account_id
-        roleId: "$role_id"
-      }
-    }
-  ) {
-    roles {
-      displayName
-      accountId
-    }
-  }
-}    
-        """).substitute(self.__dict__)
-        else:
+    def variables(self):
+        options = {"groupId": self.group_id}
+        account_grants = [{"accountId": int(account_id), "roleId": str(role_id)}
+                          for account_id, role_id in self.grants if account_id]
+        organization_grants = [{"roleId": str(role_id)}
+                               for account_id, role_id in self.grants if not account_id]
+        if account_grants:
+            options["accountAccessGrants"] = account_grants
+        if organization_grants:
             logger.info("Assigning organization scoped role to {}".format(self.group_id))
-            return Template("""
-mutation {
-  authorizationManagementGrantAccess(
-    grantAccessOptions: {
-      organizationAccessGrants: { roleId: "$role_id" }
-      groupId: "$group_id"
-    }
-  ) {
-    roles {
-      roleId
-      type
-      organizationId
-    }
-  }
-}
-
-        """).substitute(self.__dict__)
+            options["organizationAccessGrants"] = organization_grants
+        return {"options": options}
 
     def name(self):
         return "AssignRole"
 
+
+class AssignRoles(AssignRole):
+    """Every role grant of one group, account and organization scoped, in one call."""
+
+    def __init__(self, group_id, grants):
+        self.group_id = group_id
+        self.grants = list(grants)
+
+    def name(self):
+        return "AssignRoles"
+
+
+def grant_roles(client, finalize: bool, group_id, grants, max_grants: int = 100):
+    """Grant ``(accountId, roleId)`` pairs to a group, ``max_grants`` per call.
+
+    A call that comes back with errors is split in half and retried, the same
+    way ``MembershipBatch`` does. Returns the lists of granted and failed pairs.
+    """
+    granted = []
+    failed = []
+    chunks = [grants[i:i + max_grants] for i in range(0, len(grants), max(int(max_grants), 1))]
+    while chunks:
+        chunk = chunks.pop()
+        data = AssignRoles(group_id, chunk).execute(client, finalize)
+        if not data or not data.get("errors"):
+            if data:
+                granted.extend(chunk)
+        elif len(chunk) == 1:
+            logger.error("Could not assign role {} (account {}) to group {}".format(
+                chunk[0][1], chunk[0][0], group_id))
+            failed.extend(chunk)
+        else:
+            middle = len(chunk) // 2
+            chunks.extend([chunk[:middle], chunk[middle:]])
+    return granted, failed
+
+
+@functools.lru_cache(maxsize=256)
+def _aliased_document(classes):
+    definitions = []
+    fields = []
+    for index, cls in enumerate(classes):
+        prefix = "m{}_".format(index)
+        definitions.extend("${}{}:{}".format(prefix, name, type) for name, type in cls.VARIABLE_TYPES.items())
+        fields.append("m{}:{}".format(index, re.sub(r"\$(\w+)", "$" + prefix + r"\1", cls.FIELD)))
+    return "mutation MultiMutation({}){{{}}}".format(",".join(definitions), " ".join(fields))
+
+
+class MultiMutation(GraphQL):
+    """Several independent mutations packed into one document with aliases.
+
+    Operation ``i`` is sent as ``m<i>: <field>`` with its variables renamed
+    ``$m<i>_<name>``. The document only depends on the sequence of operation
+    classes, so it is built once per shape and reused. ``split`` maps the
+    combined response back to one ``{"data": ..., "errors": ...}`` result per
+    operation, shaped exactly like the response of running it alone.
+    """
+
+    def __init__(self, operations):
+        self.operations = list(operations)
+        self.IDEMPOTENT = all(op.IDEMPOTENT for op in self.operations)
+
+    def alias(self, index):
+        return "m{}".format(index)
+
+    def build_query(self):
+        return _aliased_document(tuple(type(op) for op in self.operations))
+
+    def variables(self):
+        variables = dict()
+        for index, op in enumerate(self.operations):
+            for name, value in op.variables().items():
+                variables["m{}_{}".format(index, name)] = value
+        return variables
+
+    def split(self, data):
+        if data is None:
+            return [None] * len(self.operations)
+        payload = data.get("data") or {}
+        errors = data.get("errors") or []
+        results = []
+        for i, op in enumerate(self.operations):
+            alias = self.alias(i)
+            result = {"data": {op.field: payload.get(alias)}}
+            # Errors without a path (e.g. a rejected document) apply to every operation
+            own = [e for e in errors if not e.get("path") or e["path"][0] == alias]
+            if own:
+                result["errors"] = own
+            results.append(result)
+        return results
+
+    def rejected(self, data):
+        """Whether the document as a whole was refused, so none of its operations ran."""
+        if not data or not data.get("errors") or any((data.get("data") or {}).values()):
+            return False
+        return any(not error.get("path") for error in data["errors"])
+
+    def name(self):
+        # Batches of one kind of mutation are accounted as that mutation
+        names = set(op.name() for op in self.operations)
+        return names.pop() if len(names) == 1 else "MultiMutation"
+
+
+def chunk_operations(operations, max_operations: int = 25, max_bytes: int = 32768):
+    """Group mutations into lists that fit one aliased document.
+
+    Operations are packed in order until either ``max_operations`` fields or
+    ``max_bytes`` of document text and variables would be exceeded.
+    """
+    chunk = []
+    size = 0
+    for op in operations:
+        field_size = len(op.FIELD) + len(json.dumps(op.variables()))
+        if chunk and (len(chunk) >= max_operations or size + field_size > max_bytes):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(op)
+        size += field_size
+    if chunk:
+        yield chunk
+
+
+def execute_chunk(client, finalize: bool, chunk):
+    """Send one chunk of mutations and return its ``(operation, result)`` pairs.
+
+    When the whole document is refused, for instance because one operation's
+    variables do not coerce, nothing in it ran. The chunk is then split in
+    half and each half sent again, the same way ``MembershipBatch`` does, so
+    only the offending operations fail.
+    """
+    if len(chunk) == 1:
+        return [(chunk[0], chunk[0].execute(client, finalize))]
+    batch = MultiMutation(chunk)
+    data = batch.execute(client, finalize)
+    if batch.rejected(data):
+        middle = len(chunk) // 2
+        return execute_chunk(client, finalize, chunk[:middle]) + execute_chunk(client, finalize, chunk[middle:])
+    return list(zip(chunk, batch.split(data)))
+
+
+def execute_many(client, finalize: bool, operations, max_operations: int = 25, max_bytes: int = 32768,
+                 executor=None):
+    """Send mutations through as few aliased documents as the caps allow.
+
+    Chunks are sent on ``executor`` when one is given. Either way this yields
+    ``(operation, result)`` pairs in the order the operations were given.
+    """
+    chunks = chunk_operations(operations, max_operations, max_bytes)
+    if executor is None:
+        for chunk in chunks:
+            yield from execute_chunk(client, finalize, chunk)
+        return
+    for results in executor.map(lambda chunk: execute_chunk(client, finalize, chunk), chunks):
+        yield from results
+
+
 # Make a class to dump users in the format the script expects
 # This is not used in the script but can be used to dump users in the format the script expects
-class DumpUsers(GraphQL):
+class DumpUsers(UsersQuery):
     def __init__(self, auth_domain, users):
         self.auth_domain = auth_domain
         self.users = users
-
-    def build_query(self):
-        return Template("""
-{
-  actor {
-    organization {
-      userManagement {
-        authenticationDomains(id: "$auth_domain") {
-          authenticationDomains {
-            users {
-              users {
-                type {
-                  displayName
-                  id
-                }
-                name
-                timeZone
-                groups {
-                  groups {
-                    id
-                    displayName
-                  }
-                }
-                email
-                emailVerificationState
-                id
-              }
-              nextCursor
-            }
-          }
-        }
-      }
-    }
-  }
-}
-        """).substitute(self.__dict__)
+        self.fields = DUMP_FIELDS
 
     def name(self):
         return "DumpUsers"
 
 # This is not used in the script but can be used to dump users in the format the script expects
-class DumpGroups(GraphQL):
-    def __init__(self, auth_domain):
-        self.auth_domain = auth_domain
+class DumpGroups(GroupsQuery):
+    def name(self):
+        return "DumpGroups"
 
-    def build_query(self):
-        return Template("""
-{
-  actor {
-    organization {
-      userManagement {
-        authenticationDomains(id: "$auth_domain") {
-          authenticationDomains {
-            groups {
-              groups {
-                displayName
-                id
-              }
-            }
-          }
-        }
-      }
-    }
+class AddUserToGroup(Mutation):
+    field = "userManagementAddUsersToGroups"
+    FIELD = """
+userManagementAddUsersToGroups(addUsersToGroupsOptions: $options) {
+  groups {
+    displayName
+    id
   }
 }
-        """).substitute(self.__dict__)
+"""
+    VARIABLE_TYPES = {"options": "UserManagementUsersGroupsInput!"}
 
-    def name(self):
-        return "DumpGroups"
-
-class AddUserToGroup(GraphQL):
     def __init__(self, group_id, user_id):
-        self.group_id = group_id
-        self.user_id = user_id
+        self.group_ids = [group_id]
+        self.user_ids = [user_id]
 
-    def build_query(self):
-        return Template("""
-mutation {
-  userManagementAddUsersToGroups(
-    addUsersToGroupsOptions: {
-      groupIds: ["$group_id"]
-      userIds: [$user_id]
-    }
-  ) {
-    groups {
-      displayName
-      id
-    }
-  }
-}
-        """).substitute(self.__dict__)
+    def variables(self):
+        return {"options": {"groupIds": [str(id) for id in self.group_ids],
+                            "userIds": [str(id) for id in self.user_ids]}}
 
     def name(self):
         return "AddUserToGroup"
+
+
+class AddUsersToGroups(AddUserToGroup):
+    def __init__(self, group_ids, user_ids):
+        self.group_ids = list(group_ids)
+        self.user_ids = list(user_ids)
+
+    def name(self):
+        return "AddUsersToGroups"
+
+
+class MembershipBatch:
+    """Collects (group, user) memberships and sends them in bulk.
+
+    Pending users are grouped by target group and flushed as one
+    ``userManagementAddUsersToGroups`` call per group of up to ``batch_size``
+    users. When a call comes back with errors the batch is split in half and
+    each half retried, so only the offending users end up in ``failed``.
+    Given an ``executor``, full batches are sent in the background and
+    ``flush`` waits for all of them. ``on_added(group_id, user_ids)`` is
+    called for every call that went through.
+    """
+
+    def __init__(self, client, finalize: bool, batch_size: int = 100, executor=None, on_added=None):
+        self.on_added = on_added
+        self.client = client
+        self.finalize = finalize
+        self.batch_size = max(int(batch_size), 1)
+        self.executor = executor
+        self.pending = dict()
+        self.futures = []
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.added = 0
+        self.failed = []
+
+    def add(self, group_id, user_id):
+        users = self.pending.setdefault(group_id, [])
+        if user_id not in users:
+            users.append(user_id)
+        if len(users) >= self.batch_size:
+            self.flush_group(group_id)
+
+    def flush_group(self, group_id):
+        users = self.pending.pop(group_id, [])
+        for i in range(0, len(users), self.batch_size):
+            if self.executor is None:
+                self._send(group_id, users[i:i + self.batch_size])
+            else:
+                self.futures.append(self.executor.submit(self._send, group_id, users[i:i + self.batch_size]))
+
+    def flush(self):
+        for group_id in list(self.pending):
+            self.flush_group(group_id)
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+        logger.info("Added {} memberships in {} requests ({} failed)".format(
+            self.added, self.requests, len(self.failed)))
+
+    def _send(self, group_id, user_ids):
+        logger.debug("Adding %d users to group %s", len(user_ids), group_id)
+        data = AddUsersToGroups([group_id], user_ids).execute(self.client, self.finalize)
+        with self.lock:
+            self.requests += 1
+            ok = not data or not data.get("errors")
+            if ok:
+                self.added += len(user_ids)
+        if ok:
+            if self.on_added is not None and data:
+                self.on_added(group_id, user_ids)
+            return
+        with self.lock:
+            if len(user_ids) == 1:
+                logger.error("Could not add user %s to group %s", user_ids[0], group_id)
+                self.failed.append((group_id, user_ids[0]))
+                return
+        middle = len(user_ids) // 2
+        self._send(group_id, user_ids[:middle])
+        self._send(group_id, user_ids[middle:])
@@ -0,0 +1,89 @@
+import logging
+import math
+
+logger = logging.getLogger('usermig')
+
+
+class Plan:
+    """The minimal set of mutations that brings the destination in line with the tsv.
+
+    ``users`` holds the tsv rows whose email is missing from the destination,
+    ``groups`` the group names it does not have yet, ``memberships`` the
+    ``(group name, email)`` pairs still missing and ``grants`` the
+    ``(group name, accountId, roleId)`` role grants the source group has but
+    the destination group lacks. ``rows`` counts the tsv rows read.
+    """
+
+    def __init__(self):
+        self.users = []
+        self.groups = []
+        self.memberships = []
+        self.grants = []
+        self.rows = 0
+
+    def __len__(self):
+        return len(self.users) + len(self.groups) + len(self.memberships) + len(self.grants)
+
+    def cost(self, mutation_batch_size: int = 25, membership_batch_size: int = 100, role_batch_size: int = 100):
+        """Estimate how many NerdGraph requests carrying out the plan takes."""
+        members = dict()
+        for group, email in self.memberships:
+            members[group] = members.get(group, 0) + 1
+        grants = dict()
+        for group, account_id, role_id in self.grants:
+            grants[group] = grants.get(group, 0) + 1
+        return (math.ceil(len(self.groups) / mutation_batch_size)
+                + math.ceil(len(self.users) / mutation_batch_size)
+                + sum(math.ceil(count / membership_batch_size) for count in members.values())
+                + sum(math.ceil(count / role_batch_size) for count in grants.values()))
+
+    def report(self, mutation_batch_size: int = 25, membership_batch_size: int = 100, role_batch_size: int = 100):
+        logger.info("Plan: {} users, {} groups, {} memberships and {} role grants to create".format(
+            len(self.users), len(self.groups), len(self.memberships), len(self.grants)))
+        logger.info("Estimated cost: {} requests".format(
+            self.cost(mutation_batch_size, membership_batch_size, role_batch_size)))
+
+    def write(self, out):
+        for group in self.groups:
+            out.write("create-group\t{}\n".format(group))
+        for user in self.users:
+            out.write("create-user\t{}\t{}\t{}\n".format(user.email, user.name, user.user_type))
+        for group, email in self.memberships:
+            out.write("add-membership\t{}\t{}\n".format(group, email))
+        for group, account_id, role_id in self.grants:
+            out.write("grant-role\t{}\t{}\t{}\n".format(group, account_id or "", role_id))
+
+
+def build(users, source, destination, groups=()):
+    """Diff the tsv rows against the source roles and the destination snapshot.
+
+    Role grants are brought over for the groups the rows use, and for any of
+    ``groups`` the destination already has.
+    """
+    plan = Plan()
+    seen_groups = set()
+    seen_users = set()
+    for user in users:
+        plan.rows += 1
+        if user.email.lower() in seen_users:
+            logger.warning("Ignoring repeated row for {}".format(user.email))
+            continue
+        seen_users.add(user.email.lower())
+        existing = destination.user(user.email)
+        if existing is None:
+            plan.users.append(user)
+        for group in user.groups:
+            if group not in seen_groups:
+                seen_groups.add(group)
+                if destination.group_id(group) is None:
+                    plan.groups.append(group)
+            if existing is None or group not in existing["groups"]:
+                plan.memberships.append((group, user.email))
+    for group in groups:
+        if group not in seen_groups and destination.group_id(group) is not None:
+            seen_groups.add(group)
+    for group in seen_groups:
+        missing = source.grants(group) - destination.grants(group)
+        for account_id, role_id in sorted(missing, key=str):
+            plan.grants.append((group, account_id, role_id))
+    return plan
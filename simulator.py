@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""A local stand-in for NerdGraph, for benchmarks and offline runs.
+
+Serves the user, group, role and membership queries and mutations that
+nerdgraph.py sends, including aliased batches and filtered user lookups,
+from an in-memory directory. Latency, page size, throttling and error
+rates can be injected. Point usermig at it with ``endpoint`` in the
+configuration:
+
+    ./simulator.py --port 8000 --users 1000
+    endpoint: http://127.0.0.1:8000/graphql
+"""
+
+import argparse
+import collections
+import http.server
+import itertools
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+logger = logging.getLogger('usermig')
+
+MUTATION = re.compile(r"(?:(\w+):)?((?:userManagement|authorizationManagement)\w+)\(\w+:\s*\$(\w+)\)")
+LOOKUP = re.compile(r"(\w+):users\(filter:\{email:\{eq:\$(\w+)\}\}\)")
+USER_FIELDS = ("name", "timeZone", "emailVerificationState", "type", "groups", "email")
+TYPE_NAMES = {"BASIC_USER_TIER": "Basic", "CORE_USER_TIER": "Core", "FULL_USER_TIER": "Full platform"}
+
+
+class Directory:
+    """Users, groups and role grants of every authentication domain."""
+
+    def __init__(self):
+        self.ids = itertools.count(1000)
+        self.lock = threading.Lock()
+        self.users = dict()
+        self.users_by_email = dict()
+        self.user_list = collections.defaultdict(list)
+        self.groups = dict()
+        self.group_list = collections.defaultdict(list)
+
+    def add_user(self, domain, email, name=None, user_type="BASIC_USER_TIER"):
+        with self.lock:
+            key = (domain, email.lower())
+            if key in self.users_by_email:
+                return None
+            user = {"id": str(next(self.ids)), "domain": domain, "email": email, "name": name or email,
+                    "type": user_type, "timeZone": "Etc/UTC", "emailVerificationState": "VERIFIED",
+                    "groups": []}
+            self.users[user["id"]] = user
+            self.users_by_email[key] = user
+            self.user_list[domain].append(user)
+            return user["id"]
+
+    def add_group(self, domain, name, roles=()):
+        with self.lock:
+            group = {"id": "g{}".format(next(self.ids)), "domain": domain, "name": name, "roles": set(roles)}
+            self.groups[group["id"]] = group
+            self.group_list[domain].append(group)
+            return group["id"]
+
+    def add_members(self, group_ids, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                groups = self.users[user_id]["groups"]
+                groups.extend(group_id for group_id in group_ids if group_id not in groups)
+
+    def grant(self, group_id, grants):
+        with self.lock:
+            self.groups[group_id]["roles"].update(grants)
+
+    def seed(self, domain, users, groups, groups_per_user=2, roles_per_group=2, account_id=1):
+        """Fill a domain with synthetic users spread across synthetic groups."""
+        group_ids = [self.add_group(domain, "Group {}".format(index),
+                                    [(account_id, str(role)) for role in range(roles_per_group)])
+                     for index in range(groups)]
+        for index in range(users):
+            user_id = self.add_user(domain, "user{}@example.com".format(index), "User {}".format(index))
+            if group_ids:
+                self.add_members([group_ids[(index + offset) % len(group_ids)]
+                                  for offset in range(groups_per_user)], [user_id])
+
+    def user_record(self, user, query):
+        record = {"id": user["id"]}
+        for field in USER_FIELDS:
+            if re.search(r"\b{}\b".format(field), query):
+                record[field] = user[field]
+        if "type" in record:
+            record["type"] = {"displayName": TYPE_NAMES.get(user["type"], user["type"]), "id": user["type"]}
+        if "groups" in record:
+            record["groups"] = {"groups": [{"id": group_id, "displayName": self.groups[group_id]["name"]}
+                                           for group_id in user["groups"]]}
+        return record
+
+
+class Simulator:
+    """Answers NerdGraph documents against a ``Directory``.
+
+    Each request waits ``latency`` seconds (plus up to ``jitter``), then is
+    throttled with probability ``throttle_rate`` (a 429 with ``Retry-After``)
+    or fails with probability ``error_rate`` (a 500). List queries return
+    ``page_size`` records per page.
+    """
+
+    def __init__(self, directory=None, page_size=100, latency=0.0, jitter=0.0, throttle_rate=0.0,
+                 error_rate=0.0, retry_after=0):
+        self.directory = directory or Directory()
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def handle(self, body):
+        """Return ``(status, headers, payload)`` for one POSTed document."""
+        self.count("requests")
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.throttle_rate:
+            self.count("throttled")
+            return 429, {"Retry-After": str(self.retry_after)}, {"errors": [{"message": "TOO_MANY_REQUESTS"}]}
+        if random.random() < self.error_rate:
+            self.count("errors")
+            return 500, {}, {"errors": [{"message": "Internal server error"}]}
+        request = json.loads(body)
+        query = request["query"]
+        variables = request.get("variables") or {}
+        if query.startswith("mutation"):
+            return 200, {}, self.mutate(query, variables)
+        return 200, {}, self.query(query, variables)
+
+    def mutate(self, query, variables):
+        data = dict()
+        for alias, field, variable in MUTATION.findall(query):
+            self.count(field)
+            data[alias or field] = self.apply(field, variables[variable])
+        return {"data": data}
+
+    def apply(self, field, options):
+        directory = self.directory
+        if field == "userManagementCreateUser":
+            user_id = directory.add_user(options["authenticationDomainId"], options["email"],
+                                         options.get("name"), options.get("userType", "BASIC_USER_TIER"))
+            return {"createdUser": {"id": user_id}} if user_id else None
+        if field == "userManagementCreateGroup":
+            group_id = directory.add_group(options["authenticationDomainId"], options["displayName"])
+            return {"group": {"displayName": options["displayName"], "id": group_id}}
+        if field == "userManagementAddUsersToGroups":
+            directory.add_members(options["groupIds"], options["userIds"])
+            return {"groups": [{"id": group_id, "displayName": directory.groups[group_id]["name"]}
+                               for group_id in options["groupIds"]]}
+        if field == "authorizationManagementGrantAccess":
+            grants = [(grant["accountId"], grant["roleId"]) for grant in options.get("accountAccessGrants", [])]
+            grants.extend((None, grant["roleId"]) for grant in options.get("organizationAccessGrants", []))
+            directory.grant(options["groupId"], grants)
+            return {"roles": [{"accountId": account_id, "roleId": role_id} for account_id, role_id in grants]}
+        return None
+
+    def page(self, items, cursor, key):
+        start = int(cursor or 0)
+        end = start + self.page_size
+        return {key: items[start:end], "nextCursor": str(end) if end < len(items) else None}
+
+    def query(self, query, variables):
+        directory = self.directory
+        domain = variables["authDomain"][0]
+        cursor = variables.get("cursor")
+        root = "userManagement"
+        if query.startswith("query UserLookup"):
+            self.count("UserLookup")
+            node = dict()
+            for alias, variable in LOOKUP.findall(query):
+                user = directory.users_by_email.get((domain, variables[variable].lower()))
+                node[alias] = {"users": [directory.user_record(user, query)] if user else []}
+        elif "authorizationManagement" in query:
+            self.count("RolesQuery")
+            node = {"groups": self.page(directory.group_list[domain], cursor, "groups")}
+            node["groups"]["groups"] = [
+                {"displayName": group["name"], "id": group["id"],
+                 "roles": {"roles": [{"accountId": account_id, "roleId": role_id}
+                                     for account_id, role_id in sorted(group["roles"], key=str)]}}
+                for group in node["groups"]["groups"]]
+            root = "authorizationManagement"
+        elif "users(" in query:
+            self.count("UsersQuery")
+            node = {"users": self.page(directory.user_list[domain], cursor, "users")}
+            node["users"]["users"] = [directory.user_record(user, query) for user in node["users"]["users"]]
+        else:
+            self.count("GroupsQuery")
+            node = {"groups": self.page(directory.group_list[domain], cursor, "groups")}
+            node["groups"]["groups"] = [{"displayName": group["name"], "id": group["id"]}
+                                        for group in node["groups"]["groups"]]
+        return {"data": {"actor": {"organization": {root: {
+            "authenticationDomains": {"authenticationDomains": [node]}}}}}}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status, headers, payload = self.server.simulator.handle(body)
+        self.reply(status, headers, payload)
+
+    def do_GET(self):
+        # Request counters for benchmarks
+        with self.server.simulator.lock:
+            stats = dict(self.server.simulator.stats)
+        self.reply(200, {}, stats)
+
+    def reply(self, status, headers, payload):
+        content = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(simulator, host="127.0.0.1", port=0):
+    """Start serving ``simulator`` on a background thread and return the server."""
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.simulator = simulator
+    threading.Thread(target=server.serve_forever, name="simulator", daemon=True).start()
+    return server
+
+
+def endpoint(server):
+    host, port = server.server_address[:2]
+    return "http://{}:{}/graphql".format(host, port)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on, 0 for any free port")
+    parser.add_argument("--source-domain", default="source", help="Id of the seeded source domain")
+    parser.add_argument("--users", type=int, default=1000, help="Users to seed the source domain with")
+    parser.add_argument("--groups", type=int, default=None, help="Groups to seed (default: one per 50 users)")
+    parser.add_argument("--page-size", type=int, default=100, help="Records per page of list queries")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra seconds, up to this much")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests throttled")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    directory = Directory()
+    groups = options.groups if options.groups is not None else max(options.users // 50, 1)
+    directory.seed(options.source_domain, options.users, groups)
+    server = serve(Simulator(directory, options.page_size, options.latency, options.jitter,
+                             options.throttle_rate, options.error_rate),
+                   options.host, options.port)
+    print(endpoint(server), flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
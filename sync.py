@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+
+import directory
+import export
+import nerdgraph
+import validation
+
+logger = logging.getLogger('usermig')
+
+# What a sync reads of every source user
+SYNC_FIELDS = ("id", "email", "name", "type", "groups")
+
+
+class SyncState:
+    """What ``--sync`` knew at the end of its last cycle, persisted between cycles.
+
+    ``users`` holds the source users as they were last brought over, keyed by
+    lowercase email, and ``grants`` the source role grants per group. Only
+    users and groups that differ from these are planned on the next cycle.
+    ``destination`` is the destination snapshot, kept up to date with every
+    change a cycle makes, so the destination is not read again on each
+    cycle. ``pending`` is set while a cycle is applying changes, so a crash
+    can be resumed from the journal.
+    """
+
+    def __init__(self, path, source_domain_id, destination_domain_id):
+        self.path = path
+        self.source_domain_id = source_domain_id
+        self.destination_domain_id = destination_domain_id
+        self.users = dict()
+        self.grants = dict()
+        self.destination = None
+        self.pending = False
+        self.cycles = 0
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path, "r") as f:
+            data = json.load(f)
+        if data["domains"] != [self.source_domain_id, self.destination_domain_id]:
+            raise Exception("Sync state {} belongs to domains {}, not {}".format(
+                self.path, data["domains"], [self.source_domain_id, self.destination_domain_id]))
+        self.users = data["users"]
+        self.grants = data["grants"]
+        self.destination = directory.Snapshot.from_dict(data["destination"]) if data["destination"] else None
+        self.pending = data["pending"]
+        self.cycles = data["cycles"]
+        logger.info("Loaded sync state from {}: {} users after {} cycles".format(
+            self.path, len(self.users), self.cycles))
+        return self
+
+    def save(self):
+        data = {"domains": [self.source_domain_id, self.destination_domain_id], "users": self.users,
+                "grants": self.grants, "pending": self.pending, "cycles": self.cycles,
+                "destination": self.destination.to_dict() if self.destination else None}
+        # Written aside and renamed so a crash never leaves a torn state file
+        partial = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(partial, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, self.path)
+
+
+def source_rows(client, source_domain_id):
+    """Read the source users as tsv rows, keyed by lowercase email."""
+    rows = dict()
+    query = nerdgraph.UsersQuery(source_domain_id, SYNC_FIELDS)
+    for user in query.paginate(client, True):
+        name, email, user_type, groups = export.user_row(user)
+        rows[email.lower()] = validation.Row(0, name, email, user_type, tuple(sorted(groups)))
+    return rows
+
+
+def key(row):
+    return [row.name, row.email, row.user_type, list(row.groups)]
+
+
+def delta(state, rows, source):
+    """The source users and groups that changed since the last cycle."""
+    users = [row for email, row in rows.items() if state.users.get(email) != key(row)]
+    groups = [group for group, grants in source.grants_by_group.items()
+              if state.grants.get(group) != sorted([list(grant) for grant in grants], key=str)]
+    return users, groups
+
+
+def record_applied(destination, done):
+    """Fold what a cycle's journal says it did into the destination snapshot."""
+    for name, group_id in done.groups.items():
+        destination.add_group(name, group_id)
+    for email, user_id in done.users.items():
+        destination.add_user({"id": user_id, "email": email, "groups": {"groups": []}})
+    group_names = {group_id: name for name, group_id in destination.groups_by_name.items()}
+    emails = {user["id"]: email for email, user in destination.users_by_email.items()}
+    for group_id, user_id in done.memberships:
+        if group_id in group_names and user_id in emails:
+            destination.add_membership(emails[user_id], group_names[group_id])
+    for group_id, account_id, role_id in done.grants:
+        if group_id in group_names:
+            destination.add_grants(group_names[group_id], [{"accountId": account_id, "roleId": role_id}])
+
+
+def record_synced(state, users, groups, source):
+    """Remember the users and groups the destination now matches; the rest are retried next cycle."""
+    destination = state.destination
+    for row in users:
+        existing = destination.user(row.email)
+        if existing is not None and set(row.groups) <= existing["groups"]:
+            state.users[row.email.lower()] = key(row)
+    for group in groups:
+        if source.grants(group) <= destination.grants(group):
+            state.grants[group] = sorted([list(grant) for grant in source.grants(group)], key=str)
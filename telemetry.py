@@ -0,0 +1,121 @@
+import bisect
+import json
+import logging
+import threading
+
+logger = logging.getLogger('usermig')
+
+# Upper bounds of the latency histogram, in seconds (Prometheus' defaults)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Operation:
+    """Counters and a latency histogram for one kind of NerdGraph call."""
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.sent = 0
+        self.received = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def quantile(self, fraction):
+        """Estimate a latency quantile from the histogram, as the upper bound of its bucket."""
+        rank = fraction * self.calls
+        seen = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return 0.0
+
+    def as_dict(self):
+        return {"calls": self.calls, "retries": self.retries, "errors": self.errors,
+                "bytes_sent": self.sent, "bytes_received": self.received,
+                "seconds": round(self.seconds, 6),
+                "buckets": dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"], self.buckets))}
+
+
+class Telemetry:
+    """Per-operation telemetry of a run, keyed by ``GraphQL.name()``.
+
+    ``Client.post`` records one call per request it completes, including
+    how many retries it took, how long it took end to end and the request
+    and response sizes. ``GraphQL.execute`` adds the calls that came back
+    with GraphQL errors.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = dict()
+
+    def operation(self, name):
+        operation = self.operations.get(name)
+        if operation is None:
+            operation = self.operations.setdefault(name, Operation())
+        return operation
+
+    def record(self, name, seconds: float, sent: int, received: int, retries: int = 0, failed=False):
+        with self.lock:
+            operation = self.operation(name)
+            operation.calls += 1
+            operation.retries += retries
+            operation.errors += 1 if failed else 0
+            operation.sent += sent
+            operation.received += received
+            operation.seconds += seconds
+            operation.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def error(self, name):
+        with self.lock:
+            self.operation(name).errors += 1
+
+    def summary(self):
+        """Log one line per operation, busiest first."""
+        if not self.operations:
+            return
+        logger.info("{:<20} {:>7} {:>7} {:>6} {:>9} {:>8} {:>8} {:>12} {:>12}".format(
+            "Operation", "Calls", "Retries", "Errors", "Total s", "p50 s", "p99 s", "Sent", "Received"))
+        with self.lock:
+            operations = sorted(self.operations.items(), key=lambda item: item[1].seconds, reverse=True)
+            for name, operation in operations:
+                logger.info("{:<20} {:>7} {:>7} {:>6} {:>9.2f} {:>8} {:>8} {:>12} {:>12}".format(
+                    name, operation.calls, operation.retries, operation.errors, operation.seconds,
+                    operation.quantile(0.5), operation.quantile(0.99), operation.sent, operation.received))
+
+    def write(self, path):
+        """Export to ``path``: a Prometheus textfile for ``.prom``, JSON otherwise."""
+        with self.lock, open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.prometheus())
+            else:
+                json.dump({name: operation.as_dict() for name, operation in self.operations.items()},
+                          f, indent=2)
+        logger.info("Wrote telemetry to {}".format(path))
+
+    def prometheus(self):
+        lines = []
+        counters = (("calls", "calls", "NerdGraph calls"),
+                    ("retries", "retries", "Retried NerdGraph requests"),
+                    ("errors", "errors", "NerdGraph calls that failed or returned errors"),
+                    ("request_bytes", "sent", "Bytes sent to NerdGraph"),
+                    ("response_bytes", "received", "Bytes received from NerdGraph"))
+        for metric, attribute, help in counters:
+            lines.append("# HELP usermig_{}_total {}".format(metric, help))
+            lines.append("# TYPE usermig_{}_total counter".format(metric))
+            for name, operation in sorted(self.operations.items()):
+                lines.append('usermig_{}_total{{operation="{}"}} {}'.format(metric, name,
+                                                                        getattr(operation, attribute)))
+        lines.append("# HELP usermig_latency_seconds NerdGraph call latency, retries included")
+        lines.append("# TYPE usermig_latency_seconds histogram")
+        for name, operation in sorted(self.operations.items()):
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in BUCKETS] + ["+Inf"], operation.buckets):
+                cumulative += count
+                lines.append('usermig_latency_seconds_bucket{{operation="{}",le="{}"}} {}'.format(
+                    name, bound, cumulative))
+            lines.append('usermig_latency_seconds_sum{{operation="{}"}} {}'.format(name, operation.seconds))
+            lines.append('usermig_latency_seconds_count{{operation="{}"}} {}'.format(name, operation.calls))
+        return "\n".join(lines) + "\n"
@@ -33,21 +33,36 @@ __license__ = "MIT"
 
 from string import Template
 import argparse
-import csv
+import atexit
+import cache
+import coordination
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import json
 import logging
 import logging.handlers
+import multiprocessing
 import os
+import queue
 import sys
 import yaml
 from tqdm import tqdm
 import time
-import re
+import directory
+import executor
+import export
+import journal
 import nerdgraph
+import planner
+import sync
+import validation
 
 # ----[ Globals ]----
 
 logger = logging.getLogger('usermig')
 config = None
+# Writes the queued log records out; see setup_logging
+log_listener = None
 
 # ----[ Supporting Functions ]----
 
@@ -59,8 +74,33 @@ usermig:
     loglevel: $level
     tsv: filename.tsv
     api_key: NRAK-BlahBlah
+    endpoint: https://api.newrelic.com/graphql
     source_domain_id: 
     destination_domain_id: 
+    pool_size: 10
+    membership_batch_size: 100
+    mutation_batch_size: 25
+    role_batch_size: 100
+    max_in_flight: 4
+    requests_per_second: 20
+    max_retries: 5
+    journal: usermig.journal
+    cache_dir: .usermig-cache
+    cache_ttl: 900
+    lookup_batch_size: 50
+    max_jobs: 4
+    sync_interval: 300
+    sync_full_every: 12
+    sync_state: usermig.sync.json
+    coordination: usermig.shards.db
+    log_json: 
+    # To run several migrations at once, list them as jobs. Each job takes
+    # the settings above and overrides the ones it sets:
+    # jobs:
+    #   - name: business-unit-a
+    #     tsv: business-unit-a.tsv
+    #     source_domain_id:
+    #     destination_domain_id:
     """)
     data = contents.substitute(name="UserMig", level="INFO")
     try:
@@ -102,10 +142,35 @@ class LogFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset
     }
 
+    def __init__(self):
+        super().__init__()
+        self.formatters = {level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()}
+        self.fallback = logging.Formatter()
+
+    def format(self, record):
+        return self.formatters.get(record.levelno, self.fallback).format(record)
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record, for log shippers."""
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        entry = {"time": record.created, "level": record.levelname, "process": record.process,
+                 "thread": record.threadName, "module": record.module, "function": record.funcName,
+                 "line": record.lineno, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread as they are.
+
+    The stock handler formats every record before queueing it, which is the
+    work we want off the calling thread. Records never leave this process,
+    so nothing needs to be pickled.
+    """
+
+    def prepare(self, record):
+        return record
 
 def parse_args(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__,
@@ -137,7 +202,64 @@ def parse_args(args=sys.argv[1:]):
                    action="store_true",
                    default=False,
                    help="just parse and validates the tsv file")
+    g.add_argument("--sync",
+                   action="store_true",
+                   default=False,
+                   help="Keep bringing new source users, memberships and roles over to the destination, every sync_interval seconds")
+    g.add_argument("--plan",
+                   "-p",
+                   action="store_true",
+                   default=False,
+                   help="Print the operations a migration still needs against the destination and exit")
     g = parser.add_argument_group("usermig settings")
+    g.add_argument("--resume",
+                   action="store_true",
+                   default=False,
+                   help="Resume an interrupted migration from its journal instead of starting over")
+    g.add_argument("--report",
+                   dest="report",
+                   default=None,
+                   help="With --dryrun, write every validation finding to this file as JSON lines")
+    g.add_argument("--format",
+                   dest="format",
+                   choices=export.FORMATS,
+                   default="tsv",
+                   help="Output format for --dump-users")
+    g.add_argument("--output",
+                   "-o",
+                   dest="output",
+                   default="-",
+                   help="File to write --dump-users or --plan to, - for stdout")
+    g.add_argument("--gzip",
+                   action="store_true",
+                   default=False,
+                   help="Gzip the --dump-users output (implied by an --output ending in .gz)")
+    g.add_argument("--metrics",
+                   dest="metrics",
+                   default=None,
+                   help="Write per-operation telemetry to this file, as a Prometheus textfile if it ends in .prom, JSON otherwise")
+    g.add_argument("--log-json",
+                   dest="log_json",
+                   default=None,
+                   help="Also write the log to this file as JSON lines")
+    g.add_argument("--shard",
+                   dest="shard",
+                   default=None,
+                   help="Only migrate shard I/N of the tsv (split by email hash), coordinating with the other shards on this host through the coordination file")
+    g.add_argument("--shards",
+                   dest="shards",
+                   type=int,
+                   default=None,
+                   help="Split the migration into this many shards and run them all as local processes")
+    g.add_argument("--jobs-report",
+                   dest="jobs_report",
+                   default=None,
+                   help="With jobs or shards, write every job's or shard's summary to this file as JSON")
+    g.add_argument("--no-cache",
+                   dest="no_cache",
+                   action="store_true",
+                   default=False,
+                   help="Read users, groups and roles from NerdGraph instead of the local cache, refreshing it")
     g.add_argument(
         "-c",
         "--config",
@@ -147,13 +269,22 @@ def parse_args(args=sys.argv[1:]):
         help="File to read the TSV user list from",
     )
 
+    # Set once the countdown has been shown for every job of a run
+    parser.set_defaults(confirmed=False)
     return parser.parse_args(args)
 
 def setup_logging(options):
-    """Configure logging."""
+    """Configure logging.
+
+    Callers only put their records on a queue. A listener thread formats
+    them and does the (possibly slow) writing to syslog, the terminal or the
+    JSON lines file, so logging never holds up a request.
+    """
+    global log_listener
     root = logging.getLogger("")
     root.setLevel(logging.WARNING)
     logger.setLevel(options.debug and logging.DEBUG or logging.INFO)
+    handlers = []
     if not options.silent:
         if not sys.stderr.isatty():
             facility = logging.handlers.SysLogHandler.LOG_DAEMON
@@ -162,185 +293,596 @@ def setup_logging(options):
             sh.setFormatter(
                 logging.Formatter("{0}[{1}]: %(message)s".format(
                     logger.name, os.getpid())))
-            root.addHandler(sh)
+            handlers.append(sh)
         else:
             ch = logging.StreamHandler()
             ch.setFormatter(LogFormatter())
-            root.addHandler(ch)
+            handlers.append(ch)
+        log_json = options.log_json or (config or {}).get("log_json")
+        if log_json:
+            fh = logging.FileHandler(log_json, encoding="utf-8")
+            fh.setFormatter(JsonLogFormatter())
+            handlers.append(fh)
+    if handlers:
+        log_queue = queue.SimpleQueue()
+        root.addHandler(LogQueueHandler(log_queue))
+        log_listener = logging.handlers.QueueListener(log_queue, *handlers)
+        log_listener.start()
+        atexit.register(log_listener.stop)
 
 
 # ----[ Application ]----
 
-regex = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b'
-
-def validate_row(idx, row):
-    if row.keys() >= {"Name", "Email", "User type", "Groups"}:
-        if re.fullmatch(regex, row["Email"]):
-            if row["User type"].upper() in ["BASIC_USER_TIER", "CORE_USER_TIER", "FULL_USER_TIER", "BASIC", "CORE", "FULL PLATFORM"]:
-                if row["Name"] and row["Groups"]:
-                    # All checks passed
-                    return None
-                else:
-                    return "Name or Groups is empty"
-            else:
-                return "User type is invalid"
-        else:
-            return "Email address is invalid"
-    else:
-        return "File does not have the correct header fields"
-    return "Unknown error"
-
-def parse_file(tsv_file_name):
-    with open(tsv_file_name, "r") as tsvfile:
-        reader = csv.DictReader(tsvfile, delimiter="\t")
-        data = []
-        for row in reader:
-            error = validate_row(reader.line_num, row)
-            if error is None:
-                data.append(row)
-            else:
-                logger.warning("Ignored line: {}. Reason: {}".format(reader.line_num, error))
-        return data
-
 # finish the dump_users function here as called in main. Confirm if the user exists, 
 # and then proceed to dump the users in the format this script expects for the tsv file
-def dump_users(options, api_key, source_domain_id):
+def dump_users(options, client, source_domain_id, snapshot_cache):
     logger.info("Dumping users in the format the script expects for the tsv file")
-    userinfo = (nerdgraph.UsersQuery(source_domain_id)).execute(api_key, not options.dryrun)
-    # Make sure the output is API friendly
-    normalizer = {
-        "BASIC": "BASIC_USER_TIER",
-        "CORE": "CORE_USER_TIER",
-        "FULL PLATFORM": "FULL_USER_TIER"
-    } 
-    print("Name\tEmail\tUser type\tGroups")
-    for user in userinfo['data']['actor']['organization']['userManagement']['authenticationDomains']['authenticationDomains'][0]['users']['users']:
-        print("\t".join([user['name'], user['email'],  normalizer[user['type']['displayName'].upper()], ",".join([group['displayName'] for group in user['groups']['groups']])]))
+    # The next page downloads while the current one is being written out
+    query = nerdgraph.UsersQuery(source_domain_id, nerdgraph.DUMP_FIELDS)
+    userinfo = snapshot_cache.paginate(query, client, not options.dryrun, prefetch=True)
+    with export.open_output(options.output, options.gzip) as out:
+        export.export_users(userinfo, out, options.format)
+
+def connect(shared=None):
+    """Build the NerdGraph client for the migration described by ``config``."""
+    pool_size = max(config.get("pool_size", 10), config.get("max_in_flight", 4))
+    scheduler = nerdgraph.Scheduler(rate=config.get("requests_per_second", 20),
+                                    max_concurrency=config.get("max_in_flight", 4),
+                                    max_retries=config.get("max_retries", 5),
+                                    shared=shared)
+    endpoint = config.get("endpoint", nerdgraph.NERDGRAPH_URL)
+    return nerdgraph.Client(config["api_key"], endpoint, pool_size=pool_size, scheduler=scheduler)
+
+def open_cache(options):
+    # Directory reads are served from disk while they are younger than cache_ttl
+    return cache.Cache(config.get("cache_dir", ".usermig-cache"), config.get("cache_ttl", 900),
+                       refresh=options.no_cache)
 
 def main(options):
     logger.info("Starting {} ...".format(config["name"]))
-    api_key = config["api_key"]
-    destination_domain_id = config["destination_domain_id"]
-    source_domain_id = config["source_domain_id"]
-    
+    jobs = job_configs(config)
+    if options.shards:
+        if jobs:
+            raise ValueError("Jobs can not be split into shards")
+        jobs = [dict(config, name="shard{}".format(index), shard="{}/{}".format(index, options.shards))
+                for index in range(options.shards)]
+    if jobs:
+        run_jobs(options, jobs)
+        return
+    if options.shard:
+        index, count = coordination.parse_shard(options.shard)
+        summary = job_worker(options, dict(config, name="shard{}".format(index), shard=options.shard))
+        with coordination.Coordinator(config.get("coordination", "usermig.shards.db"), options.shard) as shards:
+            summaries = shards.summaries()
+        logger.info("{} of {} shards have finished".format(len(summaries), count))
+        report_jobs(summaries)
+        if summary["status"]:
+            sys.exit(summary["status"])
+        return
+    snapshot_cache = open_cache(options)
+    with connect() as client:
+        try:
+            run(options, client, snapshot_cache, config["destination_domain_id"], config["source_domain_id"])
+        finally:
+            if options.metrics:
+                client.telemetry.write(options.metrics)
+
+def job_configs(root):
+    """Expand the ``jobs`` list of the configuration into one configuration per job.
+
+    Each job inherits every top level setting and overrides the ones it sets,
+    typically ``tsv`` and the domain ids. Jobs get their own journal and sync state.
+    """
+    jobs = root.get("jobs")
+    if not jobs:
+        return None
+    configs = []
+    for index, job in enumerate(jobs):
+        job_config = {key: value for key, value in root.items() if key != "jobs"}
+        job_config.update(job)
+        job_config["name"] = job.get("name", "job{}".format(index + 1))
+        if "journal" not in job:
+            job_config["journal"] = "{}.{}".format(job_config["name"], root.get("journal", "usermig.journal"))
+        if "sync_state" not in job:
+            job_config["sync_state"] = "{}.{}".format(job_config["name"], root.get("sync_state", "usermig.sync.json"))
+        configs.append(job_config)
+    names = [job_config["name"] for job_config in configs]
+    if len(set(names)) != len(names):
+        raise ValueError("Job names must be unique")
+    return configs
+
+# Rate limits shared by every job worker, one per API key
+shared_buckets = dict()
+
+def init_job_worker(buckets, log_queue):
+    shared_buckets.update(buckets)
+    # The parent's listener thread did not survive the fork; send records to
+    # the parent instead, which writes them out alongside its own
+    root = logging.getLogger("")
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    if log_queue is not None:
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+def job_path(path, name):
+    """Give a job its own copy of an output file, ``report.json`` becoming ``report.<name>.json``."""
+    path, extension = os.path.splitext(path)
+    return "{}.{}{}".format(path, name, extension)
+
+def job_worker(options, job_config):
+    """Run one job or shard in a worker process and summarize how it went."""
+    global config
+    config = job_config
+    options.shard = config.get("shard")
+    if options.output not in (None, "-"):
+        options.output = job_path(options.output, config["name"])
+    if options.report:
+        options.report = job_path(options.report, config["name"])
+    logger.info("Starting job {} ...".format(config["name"]))
+    status = 0
+    started = time.monotonic()
+    client = connect(shared_buckets.get(config["api_key"]))
+    try:
+        run(options, client, open_cache(options), config["destination_domain_id"], config["source_domain_id"])
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:
+        logger.exception("Job {} failed: {}".format(config["name"], e))
+        status = 2
+    finally:
+        client.close()
+    if options.metrics:
+        client.telemetry.write(job_path(options.metrics, config["name"]))
+    counters = client.scheduler.counters
+    summary = {"name": config["name"], "status": status, "seconds": round(time.monotonic() - started, 3),
+            "requests": counters["requests"], "retries": counters["retries"],
+            "throttled": counters["throttled"],
+            "errors": sum(operation.errors for operation in client.telemetry.operations.values()),
+            "operations": {name: operation.calls for name, operation in client.telemetry.operations.items()}}
+    if options.shard and not (options.plan or options.dryrun):
+        with coordination.Coordinator(config.get("coordination", "usermig.shards.db"), options.shard) as shards:
+            shards.finish(config["name"], summary)
+    return summary
+
+def run_jobs(options, jobs):
+    """Run every job on a process pool, all jobs of an API key sharing its rate limit."""
+    if (options.dump_users or options.plan) and options.output in (None, "-"):
+        # Several processes writing to stdout would interleave their output
+        logger.error("Give --output a file to write each job's output to, named after the job")
+        sys.exit(1)
+    if not (options.dryrun or options.plan or options.dump_users):
+        logger.warning("This run will commit changes for {} jobs".format(len(jobs)))
+        confirm()
+        options.confirmed = True
+    buckets = dict()
+    for job_config in jobs:
+        if job_config["api_key"] not in buckets and config.get("requests_per_second", 20):
+            buckets[job_config["api_key"]] = nerdgraph.SharedBucket(config.get("requests_per_second", 20))
+    # Shards wait on each other's groups and sync jobs never finish, so they all run at once
+    workers = len(jobs) if options.shards or options.sync else min(config.get("max_jobs", 4), len(jobs))
+    logger.info("Running {} jobs, {} at a time".format(len(jobs), workers))
+    summaries = []
+    log_queue = job_listener = None
+    if log_listener is not None:
+        log_queue = multiprocessing.Queue()
+        job_listener = logging.handlers.QueueListener(log_queue, *log_listener.handlers)
+        job_listener.start()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_job_worker,
+                             initargs=(buckets, log_queue)) as pool:
+        futures = [pool.submit(job_worker, options, job_config) for job_config in jobs]
+        for job_config, future in zip(jobs, futures):
+            try:
+                summaries.append(future.result())
+            except Exception as e:
+                logger.error("Job {} crashed: {}".format(job_config["name"], e))
+                summaries.append({"name": job_config["name"], "status": 2, "seconds": 0, "requests": 0,
+                                  "retries": 0, "throttled": 0, "errors": 0, "operations": {}})
+    if job_listener is not None:
+        job_listener.stop()
+    report_jobs(summaries)
+    if options.jobs_report:
+        with open(options.jobs_report, "w") as f:
+            json.dump(summaries, f, indent=2)
+        logger.info("Wrote job report to {}".format(options.jobs_report))
+    if any(summary["status"] for summary in summaries):
+        sys.exit(1)
+
+def report_jobs(summaries):
+    logger.info("{:<20} {:>6} {:>9} {:>9} {:>7} {:>6}".format(
+        "Job", "Status", "Seconds", "Requests", "Retries", "Errors"))
+    for summary in summaries:
+        logger.info("{:<20} {:>6} {:>9.1f} {:>9} {:>7} {:>6}".format(
+            summary["name"], "ok" if summary["status"] == 0 else "failed", summary["seconds"],
+            summary["requests"], summary["retries"], summary["errors"]))
+    logger.info("{} of {} succeeded, {} requests in total".format(
+        sum(1 for summary in summaries if summary["status"] == 0), len(summaries),
+        sum(summary["requests"] for summary in summaries)))
+    operations = dict()
+    for summary in summaries:
+        for name, calls in summary["operations"].items():
+            operations[name] = operations.get(name, 0) + calls
+    if operations:
+        logger.info("Calls: {}".format(", ".join("{} {}".format(name, calls)
+                                                 for name, calls in sorted(operations.items()))))
+
+def confirm():
+    countdown = 10
+    for i in tqdm(range(countdown), ncols=50, smoothing=50, desc="Confirming in {} seconds".format(countdown), bar_format='{l_bar} {bar}'):
+        time.sleep(1) # sleep for 1 second
+
+def run(options, client, snapshot_cache, destination_domain_id, source_domain_id):
     if options.dump_users:
-        dump_users(options, api_key, source_domain_id)
+        dump_users(options, client, source_domain_id, snapshot_cache)
+        sys.exit(0)
+
+    if options.sync:
+        logger.warning("This run will commit changes")
+        if not options.confirmed:
+            confirm()
+        sync_domains(options, client, snapshot_cache, destination_domain_id, source_domain_id)
         sys.exit(0)
        
+    # Neither domain snapshot depends on the tsv, so read them while it is parsed
+    snapshots = None
+    if not (options.dryrun or options.just_add_to_group):
+        prefetch = ThreadPoolExecutor(max_workers=2, thread_name_prefix="snapshot")
+        snapshots = (prefetch.submit(directory.Snapshot.fetch, client, source_domain_id, True,
+                                     users=False, groups=False, roles=True, cache=snapshot_cache),
+                     prefetch.submit(directory.Snapshot.fetch, client, destination_domain_id, True,
+                                     roles=True, cache=snapshot_cache))
+        prefetch.shutdown(wait=False)
+
     tsvname = config["tsv"]
     logger.info("Parsing data from {}...".format(tsvname))
-    users = parse_file(tsvname)
-    
-    if len(users) == 0:
-        logger.error("No users found in the tsv file")
-        sys.exit(1)
-    else:
-        logger.info("Found {} rows in the tsv file".format(len(users)))
 
     if options.dryrun:
+        # Check every row up front, in parallel for big files
+        known_groups = None
+        if config.get("check_groups"):
+            snapshot = directory.Snapshot.fetch(client, destination_domain_id, True, users=False,
+                                                cache=snapshot_cache)
+            known_groups = set(snapshot.groups_by_name)
+        summary = validation.validate_file(tsvname, options.report, known_groups,
+                                           workers=config.get("validation_workers"))
+        logger.info("Checked {} rows: {} valid, {} errors, {} warnings".format(
+            summary["rows"], summary["valid"], summary["errors"], summary["warnings"]))
+        if options.report:
+            logger.info("Wrote validation report to {}".format(options.report))
+        if summary["valid"] == 0:
+            logger.error("No users found in the tsv file")
+            sys.exit(1)
         logger.info("Running in dryrun mode. Exiting after validating input")
         sys.exit(0)
-    else:
-        logger.warning("This run will commit changes")
-        countdown = 10
-        for i in tqdm(range(countdown), ncols=50, smoothing=50, desc="Confirming in {} seconds".format(countdown), bar_format='{l_bar} {bar}'):
-            time.sleep(1) # sleep for 1 second
+
+    # Adding to groups streams the rows; a migration parses them all while the
+    # snapshots download, since it has to wait for them anyway
+    users = validation.read_rows(tsvname)
+    if options.shard:
+        index, count = coordination.parse_shard(options.shard)
+        users = (user for user in users if coordination.shard_of(user.email, count) == index)
+    if snapshots is not None:
+        users = iter(list(users))
+    first = next(users, None)
+    if first is None and options.shard:
+        logger.info("Shard {} has no users in the tsv file".format(options.shard))
+        sys.exit(0)
+    if first is None:
+        logger.error("No users found in the tsv file")
+        sys.exit(1)
+    users = itertools.chain([first], users)
+
+    if not options.just_add_to_group:
+        # Diff the tsv against both domains so only missing operations are issued
+        source, destination = (snapshot.result() for snapshot in snapshots)
+        plan = planner.build(users, source, destination)
+        logger.info("Found {} rows in the tsv file".format(plan.rows))
+        plan.report(config.get("mutation_batch_size", 25), config.get("membership_batch_size", 100),
+                    config.get("role_batch_size", 100))
+        if options.plan:
+            with export.open_output(options.output) as out:
+                plan.write(out)
+            sys.exit(0)
+        if len(plan) == 0:
+            logger.info("Destination is already up to date. Nothing to do")
+            sys.exit(0)
+
+    logger.warning("This run will commit changes")
+    if not options.confirmed:
+        confirm()
 
     if options.just_add_to_group:
-        add_to_group(options, api_key, users, source_domain_id)
+        add_to_group(options, client, snapshot_cache, users, source_domain_id)
         sys.exit(0)
         
-    migrate_domains(options, api_key, destination_domain_id, source_domain_id, users)
+    migrate_domains(options, client, snapshot_cache, destination_domain_id, plan, destination)
     logger.info("Done!")
 
-def migrate_domains(options, api_key, destination_domain_id, source_domain_id, users):
+def migrate_domains(options, client, snapshot_cache, destination_domain_id, plan, destination):
     logger.info("Duplicating users in the target auth domain [{}]...".format(destination_domain_id))
-    for user in users:
+    # Every completed operation is journaled so --resume can skip it next time
+    path = config.get("journal", "usermig.journal")
+    coordinator = None
+    if options.shard:
+        path = "{}.shard{}".format(path, options.shard.replace("/", "of"))
+        coordinator = coordination.Coordinator(config.get("coordination", "usermig.shards.db"), options.shard)
+    try:
+        with journal.Journal(path, destination_domain_id) as done:
+            done.open(options.resume)
+            unresolved = migrate(options, client, snapshot_cache, done, destination_domain_id, plan,
+                                 destination, coordinator)
+    finally:
+        if coordinator is not None:
+            coordinator.close()
+    if unresolved:
+        # The memberships of these groups were skipped; re-run with --resume to add them
+        logger.error("Skipped the memberships of {} groups that were not created: {}".format(
+            len(unresolved), ", ".join(unresolved)))
+        sys.exit(1)
+
+def migrate(options, client, snapshot_cache, done, destination_domain_id, plan, destination,
+            coordinator=None):
+    finalize = not options.dryrun
+    # Cached reads of whatever this run changes are dropped before changing it
+    if finalize and (plan.users or plan.memberships):
+        snapshot_cache.invalidate(destination_domain_id, "UsersQuery")
+    if finalize and plan.grants:
+        snapshot_cache.invalidate(destination_domain_id, "RolesQuery")
+    # Independent requests run concurrently; max_in_flight: 1 runs them serially, in order
+    pool = executor.Executor(config.get("max_in_flight", 4))
+    batch_size = config.get("mutation_batch_size", 25)
+    for user in plan.users:
         logger.debug(user)
 
-    # To improve execution performance we pull unique groups while looking
-    # at each user and create the group if it hasnt been created already
-    created_groups = dict()
-    for user in users:
-        logger.debug("Adding user {}".format(user["Email"]))
-        userinfo = (nerdgraph.CreateUser(user["Email"], user["Name"], user["User type"].upper(),
-                            destination_domain_id)).execute(api_key, not options.dryrun)
-        user_id = userinfo['data']['userManagementCreateUser']['createdUser']['id']
-        groups = user["Groups"].split(",")
-
-        for group in groups:
-            if group in created_groups:
-                logger.debug("Group {} was seen before. Not creating ...".format(group))
+    # Role grants for a group are dispatched as soon as its id is known, so
+    # they run alongside the rest of the group and user creation
+    grants_by_group = dict()
+    for group, account_id, role_id in plan.grants:
+        grants_by_group.setdefault(group, []).append((account_id, role_id))
+    granting = []
+
+    # With shards, each group is created and granted its roles by exactly one
+    # of them; the others wait for the group id it publishes
+    def claim_key(kind, group):
+        return "{}:{}:{}".format(kind, destination_domain_id, group)
+
+    # Grant claims cover the exact grants missing, so a later run can claim new ones
+    grant_claims = {group: "{}:{}".format(claim_key("grants", group), coordination.digest(grants))
+                    for group, grants in grants_by_group.items()}
+    if coordinator is not None:
+        grants_by_group = {group: grants for group, grants in grants_by_group.items()
+                           if coordinator.claim(grant_claims[group])}
+
+    def grant(group, group_id, grants):
+        logger.debug("Assigning %d roles to group %s", len(grants), group_id)
+        granted, failed = nerdgraph.grant_roles(client, finalize, group_id, grants,
+                                                config.get("role_batch_size", 100))
+        if granted:
+            done.roles_granted(group_id, granted)
+        if coordinator is not None:
+            if failed:
+                coordinator.release(grant_claims[group])
             else:
-                data = (nerdgraph.CreateGroup(destination_domain_id,
-                                            group)).execute(api_key, not options.dryrun)
-                id = data['data']['userManagementCreateGroup']['group']['id']
-                logger.info("Created group {} with id {} ...".format(group, id))
-                created_groups[group] = id
-
-            group_id = created_groups[group]
-            (nerdgraph.AddUserToGroup(group_id, user_id)).execute(api_key, not options.dryrun)
-
-    # We now have to tie the roles to the groups
-    role_mapping = (nerdgraph.RolesQuery(source_domain_id)).execute(api_key, not options.dryrun)
-    groups = role_mapping['data']['actor']['organization']['authorizationManagement']['authenticationDomains']['authenticationDomains'][0]['groups']['groups']
-    for group in groups:
-        # See if this group belongs to something we created
-        if group['displayName'] in created_groups:
-            group_id = created_groups[group['displayName']]
-            for role in group['roles']['roles']:
-                role_id = role['roleId']
-                account_id = role['accountId']
-                logger.debug("Assigning {} ({}) Role {} AccountId {}".format(group['displayName'], group_id, role_id, account_id))
-                nerdgraph.AssignRole(group_id, account_id,
-                                    role_id).execute(api_key, not options.dryrun)
-
-def add_to_group(options, api_key, users, source_domain_id):
-    logger.info("Running in just add to group mode")
-    all_groups_under_ad = (nerdgraph.GroupsQuery(source_domain_id)).execute(api_key, not options.dryrun)
-    for user in users:
-        groups = [group.strip() for group in user["Groups"].split(",")]
-        userinfo = (nerdgraph.UsersQuery(source_domain_id)).execute(api_key, not options.dryrun)
-        user_id = None
-        
-        # Locate the user and his existing groups
-        for userobj in userinfo['data']['actor']['organization']['userManagement']['authenticationDomains']['authenticationDomains'][0]['users']['users']:
-            if userobj['email'] == user["Email"]:
-                logger.debug("Found user {}".format(user["Email"]))
-                user_id = userobj['id']
-                for group in userobj['groups']['groups']:
-                    existing_group_name = group['displayName']
-                    if existing_group_name in groups:
-                        groups.remove(existing_group_name)
-                break
-        else:
-            logger.error("User {} not found".format(user["Email"]))
-            return
-        
-        if len(groups) == 0:
-            logger.info("User {} is already a member of all the groups specified".format(user["Email"]))
+                coordinator.publish(grant_claims[group], "granted")
+        return failed
+
+    def dispatch_grants(group, group_id):
+        grants = [(account_id, role_id) for account_id, role_id in grants_by_group.pop(group, [])
+                  if (group_id, account_id, role_id) not in done.grants]
+        if grants:
+            granting.append(pool.submit(grant, group, group_id, grants))
+
+    # Only the groups the destination is missing are created, each exactly
+    # once and several per request
+    created_groups = dict(destination.groups_by_name)
+    created_groups.update(done.groups)
+    for group in list(grants_by_group):
+        if group in created_groups:
+            dispatch_grants(group, created_groups[group])
+    missing = [group for group in plan.groups if group not in created_groups]
+    theirs = []
+    if coordinator is not None:
+        theirs = [group for group in missing if not coordinator.claim(claim_key("group", group))]
+        missing = [group for group in missing if group not in theirs]
+    # Groups that could not be created or that other shards gave up on
+    unresolved = []
+
+    def give_up(group):
+        unresolved.append(group)
+        # Let whichever shard runs next grant its roles
+        if coordinator is not None and group in grants_by_group:
+            del grants_by_group[group]
+            coordinator.release(grant_claims[group])
+
+    operations = (nerdgraph.CreateGroup(destination_domain_id, group) for group in missing)
+    try:
+        for op, data in nerdgraph.execute_many(client, finalize, operations, batch_size, executor=pool):
+            id = op.created_id(data)
+            if id is None:
+                logger.error("Could not create group {}".format(op.group_name))
+                if coordinator is not None:
+                    coordinator.release(claim_key("group", op.group_name))
+                give_up(op.group_name)
+                continue
+            logger.info("Created group {} with id {} ...".format(op.group_name, id))
+            created_groups[op.group_name] = id
+            done.group_created(op.group_name, id)
+            snapshot_cache.group_created(destination_domain_id, op.group_name, id)
+            if coordinator is not None:
+                coordinator.publish(claim_key("group", op.group_name), id)
+            dispatch_grants(op.group_name, id)
+    except Exception:
+        # A group whose request failed midway may exist; make the next run read them again
+        snapshot_cache.invalidate(destination_domain_id, "GroupsQuery")
+        snapshot_cache.invalidate(destination_domain_id, "RolesQuery")
+        raise
+    for group in theirs:
+        id = coordinator.wait(claim_key("group", group), config.get("shard_wait", 600))
+        if id is None:
+            logger.error("Group {} was not created by another shard".format(group))
+            give_up(group)
             continue
+        created_groups[group] = id
+        dispatch_grants(group, id)
+
+    # Groups all exist now; memberships are queued as each user id comes back
+    memberships = nerdgraph.MembershipBatch(client, finalize,
+                                            config.get("membership_batch_size", 100), pool,
+                                            on_added=done.members_added)
+    missing_groups = dict()
+    for group, email in plan.memberships:
+        missing_groups.setdefault(email.lower(), []).append(group)
+
+    def add_memberships(email, user_id):
+        for group in missing_groups.pop(email.lower(), []):
+            if group in created_groups and (created_groups[group], user_id) not in done.memberships:
+                memberships.add(created_groups[group], user_id)
+
+    pending = []
+    for user in plan.users:
+        if user.email in done.users:
+            add_memberships(user.email, done.users[user.email])
         else:
-            logger.info("Adding user {} to the following groups: {}".format(user["Email"], groups))
-        
-        # Make sure the groups already exist and/or create them where needed
-        for group in groups:
-            logger.debug("Looking for group {}".format(group))
-            group_id = None
-                # iterate through all_groups_under_ad and check if group exists
-            for ad_group in all_groups_under_ad['data']['actor']['organization']['userManagement']['authenticationDomains']['authenticationDomains'][0]['groups']['groups']:
-                if ad_group['displayName'] == group:
-                    logger.debug("Found group {} with id {}".format(group, ad_group['id']))
-                    group_id = ad_group['id']
-                    break
+            pending.append(user)
+    creating = set(user.email.lower() for user in pending)
+    for email in list(missing_groups):
+        if email not in creating:
+            add_memberships(email, destination.user(email)["id"])
+
+    operations = (nerdgraph.CreateUser(user.email, user.name, user_type(user),
+                                       destination_domain_id) for user in pending)
+    for user, (op, userinfo) in zip(pending, nerdgraph.execute_many(client, finalize, operations, batch_size, executor=pool)):
+        logger.debug("Adding user %s", user.email)
+        user_id = op.created_id(userinfo)
+        if user_id is None:
+            logger.error("Could not create user {}".format(user.email))
+            continue
+        done.user_created(user.email, user_id)
+        add_memberships(user.email, user_id)
+    memberships.flush()
+
+    failed = sum(len(future.result()) for future in granting)
+    logger.info("Assigned roles to {} groups ({} grants failed)".format(len(granting), failed))
+    pool.shutdown()
+    return unresolved
+
+def user_type(user):
+    """The NerdGraph user type of a row, which may use the short names the UI shows."""
+    return export.USER_TYPES.get(user.user_type.upper(), user.user_type.upper())
+
+def _looked_up(client, finalize, snapshot, users, batch_size):
+    """Yield the rows back after resolving each batch of their emails into the snapshot."""
+    users = iter(users)
+    batch = list(itertools.islice(users, batch_size))
+    while batch:
+        snapshot.lookup(client, finalize, (user.email for user in batch), batch_size)
+        yield from batch
+        batch = list(itertools.islice(users, batch_size))
+
+def sync_domains(options, client, snapshot_cache, destination_domain_id, source_domain_id):
+    logger.info("Syncing domain [{}] into [{}]...".format(source_domain_id, destination_domain_id))
+    interval = config.get("sync_interval", 300)
+    state = sync.SyncState(config.get("sync_state", "usermig.sync.json"), source_domain_id,
+                           destination_domain_id).load()
+    while True:
+        reconcile(options, client, snapshot_cache, state, destination_domain_id, source_domain_id)
+        if not interval:
+            return
+        logger.info("Next sync in {} seconds".format(interval))
+        time.sleep(interval)
+
+def reconcile(options, client, snapshot_cache, state, destination_domain_id, source_domain_id):
+    started = time.monotonic()
+    # The source is read every cycle. The destination only changes through us,
+    # so it is read on the first cycle and every sync_full_every cycles to catch drift
+    full_every = config.get("sync_full_every", 12)
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="sync") as reads:
+        rows = reads.submit(sync.source_rows, client, source_domain_id)
+        source = reads.submit(directory.Snapshot.fetch, client, source_domain_id, True,
+                              users=False, groups=False, roles=True)
+        rows, source = rows.result(), source.result()
+    if state.destination is None or (full_every and state.cycles % full_every == 0):
+        state.destination = directory.Snapshot.fetch(client, destination_domain_id, True, roles=True)
+
+    users, groups = sync.delta(state, rows, source)
+    plan = planner.build(users, source, state.destination, groups)
+    if len(plan):
+        plan.report(config.get("mutation_batch_size", 25), config.get("membership_batch_size", 100),
+                    config.get("role_batch_size", 100))
+        # An interrupted cycle is picked up from its own journal, which leaves
+        # the journal of an interrupted migration alone for --resume
+        resume = state.pending
+        state.pending = True
+        state.save()
+        with journal.Journal("{}.journal".format(state.path), destination_domain_id) as done:
+            done.open(resume)
+            migrate(options, client, snapshot_cache, done, destination_domain_id, plan, state.destination)
+            sync.record_applied(state.destination, done)
+    sync.record_synced(state, users, groups, source)
+    for email in set(state.users) - set(rows):
+        del state.users[email]
+    state.pending = False
+    state.cycles += 1
+    state.save()
+    logger.info("Sync cycle {}: {} changed users and {} changed groups, {} operations in {:.1f}s".format(
+        state.cycles, len(users), len(groups), len(plan), time.monotonic() - started))
+
+def add_to_group(options, client, snapshot_cache, users, source_domain_id):
+    logger.info("Running in just add to group mode")
+    # Only the groups are read in full; users are looked up by email a batch of rows at a time
+    snapshot = directory.Snapshot.fetch(client, source_domain_id, not options.dryrun, users=False,
+                                        cache=snapshot_cache)
+    if not options.dryrun:
+        snapshot_cache.invalidate(source_domain_id, "UsersQuery")
+    lookup_batch_size = config.get("lookup_batch_size", 50)
+    pool = executor.Executor(config.get("max_in_flight", 4))
+    memberships = nerdgraph.MembershipBatch(client, not options.dryrun,
+                                            config.get("membership_batch_size", 100), pool)
+    # Rows already processed are sent even if a later row stops the run
+    try:
+        for user in _looked_up(client, not options.dryrun, snapshot, users, lookup_batch_size):
+            groups = list(user.groups)
+
+            # Locate the user and his existing groups
+            userobj = snapshot.user(user.email)
+            if userobj is None:
+                logger.error("User {} not found".format(user.email))
+                return
+            logger.debug("Found user %s", user.email)
+            user_id = userobj['id']
+            groups = [group for group in groups if group not in userobj['groups']]
+
+            if len(groups) == 0:
+                logger.info("User {} is already a member of all the groups specified".format(user.email))
+                continue
             else:
-                logger.debug("Group {} not found. Creating ...".format(group))
-                data = (nerdgraph.CreateGroup(source_domain_id,
-                                                group)).execute(api_key, not options.dryrun)
-                id = data['data']['userManagementCreateGroup']['group']['id']
-                logger.info("Created group {} with id {} ...".format(group, id))
-                group_id = id
-            (nerdgraph.AddUserToGroup(group_id, user_id)).execute(api_key, not options.dryrun)
+                logger.info("Adding user {} to the following groups: {}".format(user.email, groups))
+
+            # Make sure the groups already exist and/or create them where needed
+            for group in groups:
+                logger.debug("Looking for group %s", group)
+                group_id = snapshot.group_id(group)
+                if group_id is not None:
+                    logger.debug("Found group %s with id %s", group, group_id)
+                else:
+                    logger.debug("Group %s not found. Creating ...", group)
+                    create = nerdgraph.CreateGroup(source_domain_id, group)
+                    try:
+                        id = create.created_id(create.execute(client, not options.dryrun))
+                    except Exception:
+                        snapshot_cache.invalidate(source_domain_id, "GroupsQuery")
+                        raise
+                    if id is None:
+                        logger.error("Could not create group {}".format(group))
+                        continue
+                    logger.info("Created group {} with id {} ...".format(group, id))
+                    group_id = id
+                    snapshot.add_group(group, group_id)
+                    snapshot_cache.group_created(source_domain_id, group, group_id)
+                memberships.add(group_id, user_id)
+                snapshot.add_membership(user.email, group)
+    finally:
+        memberships.flush()
+        pool.shutdown()
 
 
 # ----[ Entry Point ]----
@@ -0,0 +1,234 @@
+import collections
+import csv
+import itertools
+import json
+import logging
+import operator
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+logger = logging.getLogger('usermig')
+
+FIELDS = ("Name", "Email", "User type", "Groups")
+
+EMAIL = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b')
+USER_TYPES = frozenset(["BASIC_USER_TIER", "CORE_USER_TIER", "FULL_USER_TIER", "BASIC", "CORE", "FULL PLATFORM"])
+MAX_NAME_LENGTH = 255
+# Files smaller than this are validated without a process pool
+INLINE_BYTES = 4 * 1024 * 1024
+
+
+class Row(NamedTuple):
+    """One validated tsv row. Group names are split, stripped and interned up front."""
+    line: int
+    name: str
+    email: str
+    user_type: str
+    groups: tuple
+
+
+# ----[ Rules ]----
+# A rule takes a Row and returns the reason it is invalid, or None. Rules run
+# in order and the first failure wins. They have to be plain module level
+# functions so they can be shipped to worker processes.
+
+def check_email(row):
+    if not EMAIL.fullmatch(row.email):
+        return "Email address is invalid"
+
+def check_user_type(row):
+    if row.user_type.upper() not in USER_TYPES:
+        return "User type is invalid"
+
+def check_name(row):
+    if not row.name:
+        return "Name is empty"
+    if len(row.name) > MAX_NAME_LENGTH:
+        return "Name is longer than {} characters".format(MAX_NAME_LENGTH)
+
+def check_groups(row):
+    if not row.groups:
+        return "Groups is empty"
+    for group in row.groups:
+        if len(group) > MAX_NAME_LENGTH:
+            return "Group name {}... is longer than {} characters".format(group[:20], MAX_NAME_LENGTH)
+
+RULES = [check_email, check_user_type, check_name, check_groups]
+
+
+def validate_row(row, rules=RULES):
+    for rule in rules:
+        error = rule(row)
+        if error is not None:
+            return error
+    return None
+
+
+def columns_of(header):
+    """Map FIELDS to their column positions, or None if any is missing."""
+    if not set(FIELDS) <= set(header):
+        return None
+    return [header.index(field) for field in FIELDS]
+
+
+def row_factory(columns):
+    """Build a ``make_row(line, fields)`` that turns split tsv fields into a Row,
+    or None when the line is short of columns."""
+    pick = operator.itemgetter(*columns)
+    width = max(columns)
+    intern = sys.intern
+    strip = str.strip
+
+    def make_row(line, fields):
+        if len(fields) <= width:
+            return None
+        name, email, user_type, groups = pick(fields)
+        return Row(line, name, email, intern(user_type),
+                   tuple([intern(group) for group in map(strip, groups.split(",")) if group]))
+    return make_row
+
+
+def read_rows(tsv_file_name, rules=RULES):
+    """Stream the valid rows of the tsv file as compact Row records.
+
+    Invalid rows and repeats of an email already seen are logged and skipped.
+    """
+    seen = set()
+    with open(tsv_file_name, "r", newline="") as tsvfile:
+        reader = csv.reader(tsvfile, delimiter="\t")
+        columns = columns_of(next(reader, []))
+        if columns is None:
+            logger.warning("Ignored file: {}. Reason: File does not have the correct header fields".format(tsv_file_name))
+            return
+        make_row = row_factory(columns)
+        for fields in reader:
+            if not fields:
+                continue
+            row = make_row(reader.line_num, fields)
+            error = "Row is missing fields" if row is None else validate_row(row, rules)
+            if error is None and row.email.lower() in seen:
+                error = "Duplicate email"
+            if error is None:
+                seen.add(row.email.lower())
+                yield row
+            else:
+                logger.warning("Ignored line: {}. Reason: {}".format(reader.line_num, error))
+
+
+# ----[ Bulk validation ]----
+
+_worker = dict()
+
+def _init_worker(columns, rules, known_groups):
+    _worker.update(columns=columns, rules=rules, known_groups=known_groups)
+
+def _issue(line, severity, reason, email=None):
+    return {"line": line, "severity": severity, "reason": reason, "email": email}
+
+def _validate_chunk(chunk):
+    start, lines = chunk
+    columns, rules, known_groups = _worker["columns"], _worker["rules"], _worker["known_groups"]
+    make_row = row_factory(columns)
+    rows = 0
+    issues = []
+    emails = []
+    reader = csv.reader(lines, delimiter="\t")
+    for fields in reader:
+        line = start + reader.line_num - 1
+        if not fields:
+            continue
+        rows += 1
+        row = make_row(line, fields)
+        if row is None:
+            issues.append(_issue(line, "error", "Row is missing fields"))
+            continue
+        error = validate_row(row, rules)
+        if error is not None:
+            issues.append(_issue(line, "error", error, row.email))
+            continue
+        emails.append((line, row.email.lower()))
+        if known_groups is not None:
+            for group in row.groups:
+                if group not in known_groups:
+                    issues.append(_issue(line, "warning", "Unknown group {}".format(group), row.email))
+    return rows, issues, emails
+
+
+def _chunks(tsvfile, chunk_size):
+    start = 2
+    while True:
+        lines = list(itertools.islice(tsvfile, chunk_size))
+        if not lines:
+            return
+        yield start, lines
+        start += len(lines)
+
+
+def _bounded_map(pool, fn, iterable, window):
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def validate_file(tsv_file_name, report=None, known_groups=None, rules=RULES, workers=None,
+                  chunk_size: int = 50000):
+    """Validate a whole tsv file, spreading chunks of lines over worker processes.
+
+    Besides the per-row rules this flags repeated emails and, when
+    ``known_groups`` is given, group names the domain does not have. Every
+    finding is written to ``report`` as one JSON line with its line number.
+    Chunks are split on raw lines, so fields with embedded newlines are not
+    supported. Files under ``INLINE_BYTES`` are checked in this process.
+    Returns the row, valid row, error and warning counts.
+    """
+    summary = collections.Counter(rows=0, valid=0, errors=0, warnings=0)
+    seen = dict()
+    workers = workers or os.cpu_count() or 1
+    out = open(report, "w") if report else None
+    pool = None
+    try:
+        with open(tsv_file_name, "r", newline="") as tsvfile:
+            columns = columns_of(next(csv.reader([tsvfile.readline()], delimiter="\t"), []))
+            if columns is None:
+                issues = [_issue(1, "error", "File does not have the correct header fields")]
+                results = [(0, issues, [])]
+            elif workers == 1 or os.path.getsize(tsv_file_name) < INLINE_BYTES:
+                _init_worker(columns, rules, known_groups)
+                results = map(_validate_chunk, _chunks(tsvfile, chunk_size))
+            else:
+                pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                           initargs=(columns, rules, known_groups))
+                results = _bounded_map(pool, _validate_chunk, _chunks(tsvfile, chunk_size), workers * 2)
+
+            for rows, issues, emails in results:
+                summary["rows"] += rows
+                for line, email in emails:
+                    if email in seen:
+                        issues.append(_issue(line, "error", "Duplicate email (first seen on line {})".format(
+                            seen[email]), email))
+                    else:
+                        seen[email] = line
+                        summary["valid"] += 1
+                issues.sort(key=lambda issue: issue["line"])
+                for issue in issues:
+                    if issue["severity"] == "error":
+                        summary["errors"] += 1
+                        logger.warning("Ignored line: {}. Reason: {}".format(issue["line"], issue["reason"]))
+                    else:
+                        summary["warnings"] += 1
+                        logger.warning("Line {}: {}".format(issue["line"], issue["reason"]))
+                    if out:
+                        out.write(json.dumps(issue) + "\n")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if out:
+            out.close()
+    return summary